@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Compares freezetag formats and codecs on existing freezetags.
+#
+# Each freezetag is rewritten in every format, then read back the way "freezetag
+# mount" reads it: once to open a single file, and once to read every file's
+# metadata. Run from the repository root:
+#
+#   python -m benchmarks.ftag_codecs ~/music/*.ftag
+#
+# The zstd variants require the zstandard package.
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from freezetag.base import MusicMetadata
+from freezetag.core import Freezetag, FreezetagWriter, LzmaCodec, ZstdCodec
+
+VARIANTS = [
+    ('v1 lzma', 1, LzmaCodec, False),
+    ('v3 lzma', 3, LzmaCodec, False),
+    ('v3 zstd', 3, ZstdCodec, False),
+    ('v3 zstd+dict', 3, ZstdCodec, True),
+]
+
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def write(directory, frozen, checksums, version, codec, train_dictionary):
+    files = frozen.files
+    # Version 1 has no stat fields.
+    mode = 0 if version == 1 else frozen.mode
+    writer = FreezetagWriter(directory, version, mode, frozen.root, len(files), codec(), train_dictionary)
+    for f, checksum in zip(files, checksums):
+        writer.add(f, checksum)
+    writer.finish()
+    path = Path(directory) / f'{version}-{codec.name}-{train_dictionary}.ftag'
+    writer.write(path)
+    return path
+
+
+def open_first(path):
+    files = Freezetag.from_path(path).data.frozen.files
+    return files[len(files) // 2].metadata
+
+
+def read_all(path):
+    for f in Freezetag.from_path(path).data.frozen.files:
+        f.metadata
+
+
+def benchmark(path, repeat):
+    frozen = Freezetag.from_path(path).data.frozen
+    checksums = []
+    for f in frozen.files:
+        metadata = MusicMetadata.from_state(f)
+        checksums.append(metadata.checksum() if metadata else None)
+
+    print(f'{path.name} ({len(frozen.files)} files, {path.stat().st_size} bytes)')
+    print(f'  {"format":<14}{"size":>12}{"write s":>10}{"open s":>10}{"read s":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, version, codec, train_dictionary in VARIANTS:
+            if version == 1 and len(frozen.files) > 0xffff:
+                continue
+            start = time.perf_counter()
+            out = write(directory, frozen, checksums, version, codec, train_dictionary)
+            write_time = time.perf_counter() - start
+            open_time = best_time(lambda: open_first(out), repeat)
+            read_time = best_time(lambda: read_all(out), repeat)
+            print(f'  {name:<14}{out.stat().st_size:>12}{write_time:>10.3f}{open_time:>10.3f}{read_time:>10.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares freezetag formats and codecs.')
+    parser.add_argument('paths', nargs='+', type=Path, help='Freezetag files to benchmark.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of reads to time (default: 3).')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        benchmark(path, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
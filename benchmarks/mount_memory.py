@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Measures the memory "freezetag mount" uses to index each mounted file.
+#
+# A library of small FLAC files is generated and frozen one album at a time, then
+# scanned the way a mount scans its directory. The memory left allocated by the
+# scan, once no freezetags are cached, is reported per mounted file. Run from the
+# repository root:
+#
+#   python -m benchmarks.mount_memory --files 20000
+#
+# Requires FUSE, like "freezetag mount".
+import argparse
+import contextlib
+import gc
+import io
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+# Keep the checksum database out of the user's cache.
+cache_dir = tempfile.TemporaryDirectory()
+os.environ['XDG_CACHE_HOME'] = cache_dir.name
+
+from freezetag.commands import freeze
+from freezetag.freezefs import FreezeFS
+
+TRACKS_PER_ALBUM = 12
+
+
+def flac_block(block_type, data, last):
+    return bytes([(0x80 if last else 0) | block_type]) + len(data).to_bytes(3, 'big') + data
+
+
+def vorbis_comment(tags):
+    vendor = b'reference libFLAC 1.3.2'
+    data = len(vendor).to_bytes(4, 'little') + vendor + len(tags).to_bytes(4, 'little')
+    for tag in tags:
+        tag = tag.encode()
+        data += len(tag).to_bytes(4, 'little') + tag
+    return data
+
+
+def write_flac(path, rnd, artist, album, track):
+    tags = [f'ARTIST={artist}', f'ALBUM={album}', f'TITLE=Track {track}', f'TRACKNUMBER={track}']
+    path.write_bytes(b'fLaC' + flac_block(0, rnd.randbytes(34), False) +
+                     flac_block(4, vorbis_comment(tags), False) +
+                     flac_block(1, bytes(1024), True) + rnd.randbytes(256))
+
+
+def make_library(directory, count):
+    rnd = random.Random(0)
+    for i in range(0, count, TRACKS_PER_ALBUM):
+        artist = f'Artist {i // (TRACKS_PER_ALBUM * 4):05}'
+        album = f'{artist} - Album {i // TRACKS_PER_ALBUM:05}'
+        album_dir = directory / artist / album
+        album_dir.mkdir(parents=True)
+        for track in range(1, min(TRACKS_PER_ALBUM, count - i) + 1):
+            write_flac(album_dir / f'{track:02} - Track {track}.flac', rnd, artist, album, track)
+        with contextlib.redirect_stdout(io.StringIO()):
+            freeze(album_dir, backup=False, ftag=None, no_cache=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures mount memory per file.')
+    parser.add_argument('--files', type=int, default=20000, help='Number of files to mount (default: 20000).')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        library = Path(directory) / 'library'
+        print(f'generating {args.files} files...')
+        make_library(library, args.files)
+
+        tracemalloc.start()
+        fs = FreezeFS()
+        gc.collect()
+        start_size = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        fs._scan(str(library), 1)
+        scan_time = time.perf_counter() - start
+
+        # Only the index should be left.
+        for path in list(fs.freezetag_map):
+            fs._purge_ftag(path, force=True)
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0] - start_size
+        tracemalloc.stop()
+
+        mounted = len(fs.entry_map)
+        print(f'{mounted} mounted files, {size} bytes, {size / mounted:.0f} bytes per file, '
+              f'scanned in {scan_time:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
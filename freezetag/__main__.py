@@ -4,6 +4,7 @@ import sys
 from pathlib import Path
 
 from . import commands
+from .fileio import LINK_MODES
 
 
 def parse_args():
@@ -59,17 +60,51 @@ def parse_args():
                             '\nMount metadata is cached on disk, so subsequent mounts should activate in just'
                             '\na few seconds.')
     mount.add_argument('--verbose', '-v', action='store_true', help='Verbose mode.')
+    mount.add_argument('--threaded', action='store_true',
+                       help='Handle filesystem requests on multiple threads.'
+                            '\n\nBy default, requests are handled one at a time, so a slow read'
+                            '\nblocks every other reader. This mode lets concurrent readers (e.g.,'
+                            '\nmany torrent peers) be served in parallel.')
+    mount.add_argument('--lazy', action='store_true',
+                       help='Read freezetags only when their files are accessed.'
+                            '\n\nEach freezetag\'s root directory appears right away, but its'
+                            '\nfiles are only read from the freezetag when something under'
+                            '\nthat directory is listed or opened. Directories that haven\'t'
+                            '\nbeen used recently are dropped from memory again.')
+    mount.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                       help='Number of files to scan in parallel (default: 1).'
+                            '\n\nFiles are read and hashed, and freezetags decoded, by N worker'
+                            '\nthreads during the initial scan and as changes are picked up.')
+    mount.add_argument('--background-scan', action='store_true',
+                       help='Mount before the initial scan finishes.'
+                            '\n\nFiles appear under the mount point as they\'re scanned, rather'
+                            '\nthan all at once when the scan is done.')
+    mount.add_argument('--max-read', type=int, metavar='bytes',
+                       help='Maximum size of a single read request, passed to FUSE as the'
+                            '\nmax_read mount option.')
     mount.add_argument('mount_point', help='Mount destination.')
 
     shave = add_subparser('shave', 'Strip metadata from all music files.',
                           '\n\nOnly music files with supported extensions (.mp3, .flac) will be modified,'
                           '\nand only supported metadata (Vorbis comments, ID3) will be stripped.')
 
+    shave.add_argument('--in-place', action='store_true',
+                       help='Update FLAC files in place.'
+                            '\n\nInstead of rewriting each file, only its metadata blocks are'
+                            '\noverwritten, and the space they took up is kept as padding.'
+                            '\nThis is much faster for large files, but the files don\'t get'
+                            '\nany smaller. Their audio checksums are the same either way.')
+
     show = add_subparser('show', 'Display the contents of a freezetag file.')
 
     for parser in [freeze, thaw, shave]:
         parser.add_argument('directory', nargs='?', default=Path.cwd(),
                             help='Directory to process (default: current directory).')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='Don\'t use the checksum cache.'
+                                 '\n\nBy default, file checksums are cached on disk (shared with'
+                                 '\n"freezetag mount"), so files that haven\'t changed since they'
+                                 '\nwere last seen aren\'t hashed again.')
 
     show.add_argument('path', nargs='?', metavar='path', default=Path.cwd(),
                       help='Directory containing .ftag file, or the .ftag file itself\n'
@@ -95,8 +130,22 @@ def parse_args():
                            '\nthese conditions is not met.'
                            '\n\nThese checks help prevent unintentional file/directory changes'
                            '\nif thaw is called with the wrong `directory`; however, the'
-                           '\nthaw will take longer and requires user interaction for prompts.'
+                           '\nthaw may require user interaction for prompts.'
                            '\nPass --skip-checks to disable these checks.')
+    thaw.add_argument('--link-mode', choices=LINK_MODES, default='copy',
+                      help='How unmodified files are copied (default: copy).'
+                           '\n\nApplies to non-music files when --to is used, and to files'
+                           '\nfrozen under multiple paths.'
+                           '\n  copy      Copy the file contents.'
+                           '\n  reflink   Clone the file contents (btrfs, XFS). The copies'
+                           '\n            take no extra disk space until modified.'
+                           '\n  hardlink  Hardlink the files. Note that hardlinked files are'
+                           '\n            the same file, so modifying one modifies both.'
+                           '\n  auto      Reflink if supported, copy otherwise.')
+    thaw.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                      help='Number of files to verify in parallel (default: 1).'
+                           '\n\nFiles in `directory` are read and hashed by N worker threads'
+                           '\nbefore anything is moved or copied.')
 
     freeze.add_argument('--backup', action='store_true',
                         help='Freeze in incremental backup mode.'
@@ -109,6 +158,20 @@ def parse_args():
                              '\nread. Any files whose names haven\'t changed will not have their'
                              '\nhashes recalculated, making the freeze operation significantly'
                              '\nfaster.')
+    freeze.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                        help='Number of files to process in parallel (default: 1).'
+                             '\n\nFiles are read, stripped, and hashed by N worker threads. The'
+                             '\nresulting freezetag is identical to one created with a single'
+                             '\njob.')
+    freeze.add_argument('--codec', choices=['lzma', 'zstd'], default='lzma',
+                        help='Compression used for metadata (default: lzma).'
+                             '\n\nzstd freezetags are slightly larger but decompress several'
+                             '\ntimes faster, which helps "freezetag mount" with many freezetags.'
+                             '\nReading them requires the zstandard package, and they have'
+                             '\ndifferent IDs than lzma freezetags of the same files.')
+    freeze.add_argument('--dictionary', action='store_true',
+                        help='Train a zstd dictionary on the metadata and store it in the'
+                             '\nfreezetag. Requires --codec zstd.')
     freeze.add_argument('--ftag', metavar='path',
                         help='Path to output freezetag file.'
                              '\n\nIf path is a directory, the freezetag file will be written to'
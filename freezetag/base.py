@@ -1,8 +1,11 @@
 import hashlib
+import itertools
+import os
+from threading import Lock
 
 from construct import *
 
-from . import formats
+from . import fileio, formats
 
 
 class ParsedFile:
@@ -35,9 +38,14 @@ class ParsedFile:
     def restore_metadata(self, metadata):
         raise NotImplementedError()
 
-    def checksum(self):
+    # Returns the current state of the file (including any stripped or restored
+    # metadata) as a list of regions. See fileio.iter_regions.
+    def regions(self):
         raise NotImplementedError()
 
+    def checksum(self):
+        return fileio.hash_regions(self.path, self.regions())
+
 
 class MusicMetadata:
     @staticmethod
@@ -59,9 +67,17 @@ class MusicMetadata:
     def __iter__(self):
         raise NotImplementedError()
 
+    # Yields (container, key) for each field holding raw tag data, such as
+    # embedded pictures, in the order they're built. Identical fields are
+    # deduplicated in freezetags and in memory.
+    def blobs(self):
+        return iter(())
+
 
 class MusicParsedFile(ParsedFile):
     def parse(self):
+        # Only the metadata is parsed. The audio is left on disk and is referenced
+        # by the instance's audio_offset and audio_len.
         instance = self.format.parse_file(self.path)
 
         # Workaround for https://github.com/construct/construct/issues/852
@@ -69,16 +85,18 @@ class MusicParsedFile(ParsedFile):
 
         return instance
 
-    def checksum(self):
-        b = self.format.build(self.instance)
-        return hashlib.sha1(b).digest()
-
-    def write(self, path):
-        self.format.build_file(self.instance, path)
+    # Writes the file to path, which may be the source file itself. If padding is
+    # True, formats that support it may keep space freed by removed metadata as
+    # padding so the file can be updated in place.
+    def write(self, path, padding=False):
+        fileio.write_regions(self.path, self.regions(), path)
 
 
 class FuseFile:
-    fh = 0
+    _fh_counter = itertools.count()
+
+    # Sequential reads smaller than this are served from a buffer of this size.
+    READAHEAD_SIZE = 256 * 1024
 
     @staticmethod
     def from_info(file_path, *args):
@@ -90,13 +108,86 @@ class FuseFile:
         return formats.generic.FuseFile(file_path, *args)
 
     def __init__(self, file_path, flags, metadata, file_metadata_info, file_metadata_len, frozen_metadata_len):
-        self.file = file_path.open('rb')
+        self.file = file_path.open('rb', buffering=0)
+        self.file_size = os.fstat(self.file.fileno()).st_size
         self.metadata = metadata
-        self.fh = FuseFile.fh
-        FuseFile.fh += 1
+        self.fh = next(FuseFile._fh_counter)
+        self._segments = None
+        self._readahead = b''
+        self._readahead_offset = 0
+        self._next_offset = None
+
+        # Must be acquired around read() and close() if the handle is shared between threads.
+        self.lock = Lock()
+
+    # Returns the layout of the file as seen through the mount, as a list of
+    # (length, source) tuples. source is either an offset into the backing file or
+    # a function returning the segment's bytes.
+    def segments(self):
+        raise NotImplementedError()
 
     def read(self, length, offset):
-        raise NotImplementedError()
+        if self._segments is None:
+            self._segments = self.segments()
+
+        parts = []
+        for segment_len, source in self._segments:
+            if offset >= segment_len:
+                offset -= segment_len
+                continue
+
+            end = min(segment_len, offset + length)
+            if callable(source):
+                parts.append(source()[offset:end])
+            else:
+                parts.append(self._read_file(end - offset, source + offset))
+            length -= end - offset
+            offset = 0
+            if not length:
+                break
+
+        # Most reads fall within a single segment, so avoid copying them again.
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def _read_file(self, length, offset):
+        start = self._readahead_offset
+        readahead = self._readahead
+
+        if start <= offset and offset + length <= start + len(readahead):
+            b = readahead[offset - start:offset - start + length]
+        elif offset == self._next_offset and length < self.READAHEAD_SIZE:
+            self._readahead = readahead = self._pread(self.READAHEAD_SIZE, offset)
+            self._readahead_offset = offset
+            b = readahead[:length]
+        else:
+            b = self._pread(length, offset)
+
+        self._next_offset = offset + len(b)
+        return b
+
+    # Reads into new bytes rather than a reused buffer: fusepy only accepts bytes
+    # from read(), so a buffer would need copying out anyway.
+    def _pread(self, length, offset):
+        if not hasattr(os, 'pread'):
+            # Windows.
+            self.file.seek(offset, 0)
+            return self.file.read(length)
+
+        fd = self.file.fileno()
+        b = os.pread(fd, length, offset)
+        if len(b) == length or not b:
+            return b
+
+        # Short reads are only expected at the end of the file.
+        parts = [b]
+        while length > len(b):
+            length -= len(b)
+            offset += len(b)
+            b = os.pread(fd, length, offset)
+            if not b:
+                break
+            parts.append(b)
+        return b''.join(parts)
 
     def close(self):
         self.file.close()
@@ -1,21 +1,25 @@
 #!/usr/bin/env python3
-import hashlib
 import json
 import os
 import re
 import shutil
+import sqlite3
 import sys
 from datetime import datetime
 from pathlib import Path
 
 from .base import ParsedFile, MusicMetadata
-from .core import Freezetag
+from .core import ChecksumDB, Freezetag, FreezetagWriter, codec_by_name
+from .fileio import link_file
+from .workers import ordered_map
 
-# Version 2 is used only for "freeze --backup" freezetags.
+# Version 3 is used only for "freeze --backup" freezetags, which can be much larger
+# than a single album, and when a codec other than lzma is chosen. Version 2 can
+# still be read.
 # All other freezetags are still created using version 1 so the bytes/IDs stay consistent.
 # These can be unified in a future version if the schema is updated.
 DEFAULT_VERSION = 1
-VERSION = 2
+VERSION = 3
 
 DEFAULT_MODE = 0
 BACKUP_MODE = 1
@@ -27,8 +31,8 @@ class CommandException(Exception):
     pass
 
 
-def get_version(is_backup):
-    return VERSION if is_backup else DEFAULT_VERSION
+def get_version(is_backup, codec='lzma'):
+    return VERSION if is_backup or codec != 'lzma' else DEFAULT_VERSION
 
 
 def get_mode(is_backup):
@@ -45,10 +49,6 @@ class Reprinter():
         self.last_width = len(text)
 
 
-def hash_bytes(b):
-    return hashlib.sha1(b).digest()
-
-
 def find_ftag(path):
     if not path.exists():
         raise CommandException(f'Given ftag is not a file or directory: {path}')
@@ -77,6 +77,18 @@ def find_ftag(path):
     return freezetag_paths[index]
 
 
+# Returns the shared checksum cache, or None if it's disabled or unavailable.
+def open_checksum_db(no_cache):
+    if no_cache:
+        return None
+
+    try:
+        return ChecksumDB()
+    except (OSError, sqlite3.Error) as e:
+        print(f'Cannot open checksum cache: {e}', file=sys.stderr)
+        return None
+
+
 def walk_dir(path):
     for dirpath, dirnames, filenames in os.walk(path):
         dirnames.sort()
@@ -89,11 +101,13 @@ def walk_dir(path):
             yield p, p.relative_to(path)
 
 
-def shave(directory, **kwargs):
+def shave(directory, in_place=False, no_cache=False, **kwargs):
     root = Path(directory).resolve()
     if not root.exists():
         raise CommandException(f'Directory does not exist: {root}')
 
+    checksum_db = open_checksum_db(no_cache)
+
     for path, rel_path in walk_dir(root):
         file = ParsedFile.from_path(path)
 
@@ -102,6 +116,12 @@ def shave(directory, **kwargs):
 
         print(path.name)
 
+        # Files already known to have no metadata don't need to be parsed.
+        cached = checksum_db and checksum_db.get(path, os.stat(path))
+        if cached and not cached[2]:
+            print('    no metadata found')
+            continue
+
         metadata = file.strip()
 
         if not next(iter(metadata), None):
@@ -110,22 +130,44 @@ def shave(directory, **kwargs):
 
         print('    shaved {0}'.format(', '.join(f'{label} ({size})' for label, size in metadata)))
 
-        file.write(path)
+        file.write(path, padding=in_place)
+
 
+def checksum_file(paths, checksum_db=None):
+    path, rel_path = paths
+    file = ParsedFile.from_path(path)
 
-def prepare_thaw(root, frozen, thaw_in_place, checksum_to_item):
+    if checksum_db:
+        # Stat before reading so that changes made while hashing invalidate the entry.
+        st = os.stat(path)
+        cached = checksum_db.get(path, st)
+        if cached:
+            # The file is parsed later if it's thawed.
+            return path, rel_path, file, cached[0]
+
+    metadata = file.strip()
+    checksum = file.checksum()
+    if checksum_db:
+        checksum_db.add(path, st, checksum, list(metadata) if metadata else [], metadata.size if metadata else 0,
+                        metadata.checksum() if metadata else None)
+    return path, rel_path, file, checksum
+
+
+# Hashes every file in root and maps its relative path to (path, item, file),
+# where item is its checksum_to_item entry and file is its ParsedFile.
+# The parsed files are reused when thawing so that each file is parsed and
+# hashed only once.
+def prepare_thaw(root, frozen, thaw_in_place, checksum_to_item, skip_checks=False, jobs=1, checksum_db=None):
     paths = {}
     commonpath = None
     unrecognized_found = False
     reprinter = Reprinter()
 
-    for path, rel_path in walk_dir(root):
+    # Files are hashed by the worker pool; results are handled in walk order.
+    fn = lambda paths: checksum_file(paths, checksum_db)
+    for path, rel_path, file, checksum in ordered_map(fn, walk_dir(root), jobs):
         reprinter.print(f'Checking...{rel_path}')
 
-        file = ParsedFile.from_path(path)
-        file.strip()
-        checksum = file.checksum()
-
         if checksum not in checksum_to_item:
             unrecognized_found = True
             reprinter.print(f'    Unrecognized file: {path}')
@@ -133,12 +175,15 @@ def prepare_thaw(root, frozen, thaw_in_place, checksum_to_item):
             continue
 
         checksum_to_item[checksum][1] = True
-        paths[rel_path] = checksum_to_item[checksum]
+        paths[rel_path] = (path, checksum_to_item[checksum], file)
         commonpath = os.path.commonpath(list(filter(None, [commonpath, path])))
 
     reprinter.print('Checking...done.')
     print()
 
+    if skip_checks:
+        return paths
+
     if thaw_in_place and unrecognized_found and Path(commonpath) != root:
         print(f'\nCommon path ({commonpath}) does not match thaw directory ({root}).')
         print(f"You're thawing in-place, so the structure of {root} will be changed.")
@@ -171,7 +216,7 @@ def prepare_thaw(root, frozen, thaw_in_place, checksum_to_item):
     return paths
 
 
-def thaw(directory, to, ftag, skip_checks, **kwargs):
+def thaw(directory, to, ftag, skip_checks, jobs=1, link_mode='copy', no_cache=False, **kwargs):
     root = Path(directory).resolve()
     if not root.exists():
         raise CommandException(f'Directory does not exist: {root}')
@@ -197,30 +242,24 @@ def thaw(directory, to, ftag, skip_checks, **kwargs):
 
     print(f'Processing {root}...')
 
-    # First pass: verify directory and calculate checksums.
-    path_to_item = None
-    if not skip_checks:
-        path_to_item = prepare_thaw(root, frozen, thaw_in_place, checksum_to_item)
+    # First pass: calculate checksums and verify directory.
+    checksum_db = open_checksum_db(no_cache)
+    path_to_item = prepare_thaw(root, frozen, thaw_in_place, checksum_to_item, skip_checks, jobs, checksum_db)
 
     reprinter = Reprinter()
-    import_fn = shutil.move if thaw_in_place else shutil.copy2
+    copy_fn = lambda src, dst: link_file(src, dst, link_mode)
+    import_fn = shutil.move if thaw_in_place else copy_fn
 
-    # Second pass: move (or copy) files to tmp_dir and update their metadata.
-    for path, rel_path in walk_dir(root):
-        file = None
-
-        if path_to_item:
-            if rel_path not in path_to_item:
-                continue
-            item = path_to_item[rel_path]
-        else:
-            file = ParsedFile.from_path(path)
-            file.strip()
-            checksum = file.checksum()
-            if checksum not in checksum_to_item:
-                continue
-            item = checksum_to_item[checksum]
+    # Caches the checksums of thawed files so that freezing them again is fast.
+    def cache_thawed(to_path, state):
+        if not checksum_db:
+            return
+        metadata = MusicMetadata.from_state(state)
+        checksum_db.add(to_path, os.stat(to_path), state.checksum, list(metadata) if metadata else [],
+                        metadata.size if metadata else 0, metadata.checksum() if metadata else None)
 
+    # Second pass: move (or copy) files to tmp_dir and update their metadata.
+    for rel_path, (path, item, file) in path_to_item.items():
         reprinter.print(f'Thawing metadata...{rel_path}')
 
         if item[2]:
@@ -237,19 +276,33 @@ def thaw(directory, to, ftag, skip_checks, **kwargs):
                     if len(item[0]) == 1:
                         import_fn(path, to_path)
                     else:
-                        shutil.copy2(path, to_path)
+                        copy_fn(path, to_path)
                 except shutil.SameFileError:
                     pass
+                except OSError as e:
+                    if link_mode not in ('reflink', 'hardlink'):
+                        raise
+                    # Copies are the only thing in tmp_dir unless thawing in-place.
+                    if not thaw_in_place:
+                        shutil.rmtree(tmp_dir, ignore_errors=True)
+                    raise CommandException(f'Cannot {link_mode} {path} to {to_path}: {e.strerror}\n'
+                                           'Use --link-mode auto or --link-mode copy instead.')
+                cache_thawed(to_path, state)
                 continue
 
-            if not file:
-                file = ParsedFile.from_path(path)
+            # When thawing in-place, move the file rather than writing a copy of
+            # it. This lets formats that support it update just the metadata.
+            if thaw_in_place and len(item[0]) == 1:
+                shutil.move(path, to_path)
+                file.path = to_path
 
             file.restore_metadata(state.metadata)
             file.write(to_path)
+            cache_thawed(to_path, state)
 
-        if thaw_in_place and rel_path.parts[0] != tmp_dir.name and path.exists():
-            path.unlink()
+        if thaw_in_place and rel_path.parts[0] != tmp_dir.name:
+            if path.exists():
+                path.unlink()
             parent = path.parent
             while not len(os.listdir(parent)):
                 parent.rmdir()
@@ -277,11 +330,20 @@ def thaw(directory, to, ftag, skip_checks, **kwargs):
             root.rename(new_root)
 
 
-def freeze(directory, backup, ftag, **kwargs):
+def freeze(directory, backup, ftag, jobs=1, no_cache=False, codec='lzma', dictionary=False, **kwargs):
     root = Path(directory).resolve()
     if not root.exists():
         raise CommandException(f'Directory does not exist: {root}')
 
+    if dictionary and codec == 'lzma':
+        raise CommandException('--dictionary requires --codec zstd.')
+
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise CommandException('The zstd codec requires the zstandard package (pip install zstandard).')
+
     tmp_paths = [p for p in root.iterdir() if p.suffix.lower() == '.ftag-tmp']
 
     # We're trying to create a new freeze state, but we found existing freezetag tmp
@@ -293,17 +355,15 @@ def freeze(directory, backup, ftag, **kwargs):
             'Run freezetag thaw again to finish processing.')
 
     to_path = Path(ftag or root)
+    to_dir = to_path if to_path.is_dir() else to_path.parent
     existing = {}
-    files = []
-    music_checksums = []
-    metadata_checksums = []
     last_ftag = (None, 0)
+    last_root = None
     reprinter = Reprinter()
 
     reprinter.print('Collecting metadata...')
 
     if backup:
-        to_dir = to_path if to_path.is_dir() else to_path.parent
         for f in to_dir.iterdir():
             if not re.match('F\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}\.ftag', f.name):
                 continue
@@ -312,84 +372,100 @@ def freeze(directory, backup, ftag, **kwargs):
                 last_ftag = (f, mtime)
         if last_ftag[0]:
             last_frozen = Freezetag.from_path(last_ftag[0]).data.frozen
+            last_root = last_frozen.root
             for f in last_frozen.files:
                 existing[f.path] = f
+            # Files are dropped from existing as they're reused, so the last
+            # freezetag's metadata doesn't all stay in memory.
+            del last_frozen
 
+    existing_count = len(existing)
     existing_path_count = 0
+    checksum_db = open_checksum_db(no_cache)
 
-    for path, rel_path in walk_dir(root):
-        checksum = None
+    # The paths are listed up front since the number of files is written before
+    # the files themselves.
+    paths = list(walk_dir(root))
 
-        if str(rel_path) in existing:
-            stat = os.stat(path)
-            state = existing[str(rel_path)]
+    def freeze_file(paths):
+        path, rel_path = paths
+        stat = os.stat(path)
+
+        state = existing.pop(str(rel_path), None)
+        if state:
             if stat.st_size == state.stat.size and abs(stat.st_mtime - state.stat.mtime) < 1e-3:
-                files.append(f)
-                existing_path_count += 1
                 metadata = MusicMetadata.from_state(state)
-                checksum = state.checksum
+                return rel_path, state, metadata.checksum() if metadata else None, True
 
+        # The metadata is always parsed since it's saved in the freezetag, but the
+        # checksums can come from the cache.
         file = ParsedFile.from_path(path)
-
-        if not checksum:
-            metadata = file.strip()
+        metadata = file.strip()
+        cached = checksum_db and checksum_db.get(path, stat)
+        if cached:
+            checksum = cached[0]
+            metadata_checksum = cached[3] or (metadata.checksum() if metadata else None)
+        else:
             checksum = file.checksum()
-
-            dict = {
-                'path': rel_path.as_posix(),
-                'format': file.format_id,
-                'checksum': checksum,
-                'metadata': metadata.value if metadata else None,
+            metadata_checksum = metadata.checksum() if metadata else None
+            if checksum_db:
+                checksum_db.add(path, stat, checksum, list(metadata) if metadata else [],
+                                metadata.size if metadata else 0, metadata_checksum)
+
+        dict = {
+            'path': rel_path.as_posix(),
+            'format': file.format_id,
+            'checksum': checksum,
+            'metadata': metadata.value if metadata else None,
+        }
+
+        if backup:
+            dict['stat'] = {
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
             }
+        else:
+            dict['stat'] = None
 
-            if backup:
-                stat = os.stat(path)
-                dict['stat'] = {
-                    'mtime': stat.st_mtime,
-                    'size': stat.st_size,
-                }
-            else:
-                dict['stat'] = None
+        return rel_path, dict, metadata_checksum, False
 
-            files.append(dict)
+    # Each file is written to the freezetag as soon as it's processed, so only
+    # the checksums are kept in memory until the end.
+    writer = FreezetagWriter(to_dir, get_version(backup, codec), get_mode(backup), root.name, len(paths),
+                             codec_by_name(codec)(), dictionary)
+    try:
+        # Files are processed by the worker pool, but results come back in walk order
+        # so that the freezetag is identical to one created serially.
+        for rel_path, dict, metadata_checksum, is_existing in ordered_map(freeze_file, paths, jobs):
+            writer.add(dict, metadata_checksum)
 
-        if file.format:
-            music_checksums.append(checksum)
-            metadata_checksum = metadata.checksum()
-            metadata_checksums.append(metadata_checksum)
+            if is_existing:
+                existing_path_count += 1
 
-        reprinter.print(f'Collecting metadata...{rel_path}')
+            reprinter.print(f'Collecting metadata...{rel_path}')
 
-    reprinter.print('Collecting metadata...done.')
-    print()
+        reprinter.print('Collecting metadata...done.')
+        print()
 
-    if not len(music_checksums):
-        raise CommandException('No music files found.')
+        if not len(writer.music_checksums):
+            raise CommandException('No music files found.')
 
-    if existing_path_count == len(existing) and existing_path_count == len(files) \
-            and last_frozen.root == root.name:
-        print(f'No changes since last freezetag ({last_ftag[0].name}).')
-        return
+        if existing_path_count == existing_count and existing_path_count == len(paths) \
+                and last_root == root.name:
+            print(f'No changes since last freezetag ({last_ftag[0].name}).')
+            return
 
-    print('Building freezetag...')
+        print('Building freezetag...')
 
-    freezetag = Freezetag({
-        'signature': b'freezetag',
-        'version': get_version(backup),
-        'frozen': {
-            'mode': get_mode(backup),
-            'music_checksum': hash_bytes(b''.join(sorted(music_checksums)))[0:8],
-            'metadata_checksum': hash_bytes(b''.join(sorted(metadata_checksums)))[0:4],
-            'root': root.name,
-            'files': files,
-        },
-    })
+        writer.finish()
 
-    if to_path.is_dir():
-        filename = 'F' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') if backup else freezetag.get_id()
-        to_path = to_path / f'{filename}.ftag'
+        if to_path.is_dir():
+            filename = 'F' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') if backup else writer.get_id()
+            to_path = to_path / f'{filename}.ftag'
 
-    freezetag.write(to_path)
+        writer.write(to_path)
+    finally:
+        writer.discard()
 
     print(f'Freezetag created at {to_path}')
 
@@ -426,6 +502,7 @@ def show(path, as_json, **kwargs):
             print(f'{f.checksum.hex()} {f.path}')
 
 
-def mount(directory, mount_point, verbose, **kwargs):
+def mount(directory, mount_point, verbose, threaded=False, max_read=None, lazy=False, jobs=1, background_scan=False,
+          **kwargs):
     from .freezefs import FreezeFS
-    FreezeFS(verbose).mount(directory, mount_point)
+    FreezeFS(verbose, lazy).mount(directory, mount_point, threaded, max_read, jobs, background_scan)
@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 import hashlib
+import lzma
+import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+from threading import Lock
 
+from appdirs import user_cache_dir
 from construct import *
 
+from .base import MusicMetadata
 from .formats import generic, flac, mp3
 
 # Used for FrozenFormat > files > format.
@@ -10,23 +19,42 @@ generic.ParsedFile.format_id = 0
 flac.ParsedFile.format_id = 1
 mp3.ParsedFile.format_id = 2
 
-# Used for freezetag mount cache.
-DB_VERSION = 1
+# Used for the checksum cache.
+DB_VERSION = 3
+
+# construct also exports a Path.
+CACHE_DIR = pathlib.Path(user_cache_dir('freezetag', 'x1ppy'))
+
+FrozenFileV1Format = Struct(
+    'path' / CString('utf8'),
+    'format' / Int8ub,
+    'checksum' / Bytes(20),
+    'metadata' / Switch(this.format, {
+        1: flac.FrozenMetadataFormat,
+        2: mp3.FrozenMetadataFormat,
+    }),
+)
 
 FrozenFormatV1 = Struct(
     'mode' / Computed(0),
     'music_checksum' / Bytes(8),
     'metadata_checksum' / Bytes(4),
     'root' / CString('utf8'),
-    'files' / Compressed(PrefixedArray(Int16ub, Struct(
-        'path' / CString('utf8'),
-        'format' / Int8ub,
-        'checksum' / Bytes(20),
-        'metadata' / Switch(this.format, {
-            1: flac.FrozenMetadataFormat,
-            2: mp3.FrozenMetadataFormat,
-        }),
-    )), 'lzma'),
+    'files' / Compressed(PrefixedArray(Int16ub, FrozenFileV1Format), 'lzma'),
+)
+
+FrozenFileV2Format = Struct(
+    'path' / CString('utf8'),
+    'format' / Int8ub,
+    'checksum' / Bytes(20),
+    'stat' / If(this._._.mode == 1, Struct(
+        'mtime' / Double,
+        'size' / Long,
+    )),
+    'metadata' / Switch(this.format, {
+        1: flac.FrozenMetadataFormat,
+        2: mp3.FrozenMetadataFormat,
+    }),
 )
 
 FrozenFormatV2 = Struct(
@@ -34,19 +62,372 @@ FrozenFormatV2 = Struct(
     'music_checksum' / Bytes(8),
     'metadata_checksum' / Bytes(4),
     'root' / CString('utf8'),
-    'files' / Compressed(PrefixedArray(Int16ub, Struct(
-        'path' / CString('utf8'),
-        'format' / Int8ub,
-        'checksum' / Bytes(20),
-        'stat' / If(this._._.mode == 1, Struct(
-            'mtime' / Double,
-            'size' / Long,
-        )),
-        'metadata' / Switch(this.format, {
-            1: flac.FrozenMetadataFormat,
-            2: mp3.FrozenMetadataFormat,
-        }),
-    )), 'lzma'),
+    'files' / Compressed(PrefixedArray(Int16ub, FrozenFileV2Format), 'lzma'),
+)
+
+# Chunks are closed once they hold this many files or this many bytes
+# of metadata, whichever comes first.
+CHUNK_MAX_FILES = 256
+CHUNK_MAX_SIZE = 1024 * 1024
+
+# Size of the zstd dictionaries trained by FreezetagWriter, and how much metadata
+# they're trained on.
+DICTIONARY_SIZE = 64 * 1024
+DICTIONARY_SAMPLE_SIZE = 8 * 1024 * 1024
+
+# Blobs (see MusicMetadata.blobs) at least this large are stored once per
+# freezetag in version 3, and are shared in memory when a freezetag is loaded.
+BLOB_MIN_SIZE = 1024
+
+
+class LzmaCodec:
+    id = 0
+    name = 'lzma'
+
+    def __init__(self, dictionary=b''):
+        if dictionary:
+            raise ValueError('lzma does not support dictionaries')
+        self.dictionary = b''
+
+    def train(self, samples):
+        pass
+
+    def compress(self, data):
+        return lzma.compress(data)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+# Decompresses several times faster than lzma, at the cost of slightly larger files.
+# Requires the zstandard package, which is only imported once something is
+# compressed or decompressed, so that freezetags can still be listed without it.
+class ZstdCodec:
+    id = 1
+    name = 'zstd'
+    level = 19
+
+    def __init__(self, dictionary=b''):
+        self.dictionary = dictionary
+        self._compressor = None
+
+    def _dict_data(self):
+        import zstandard
+        return zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+
+    # Trains a dictionary on samples, a list of byte strings, for compressing
+    # similar data. Can only be called before anything is compressed.
+    def train(self, samples):
+        import zstandard
+        try:
+            self.dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, samples).as_bytes()
+        except zstandard.ZstdError:
+            # Too few samples.
+            pass
+
+    def compress(self, data):
+        if not self._compressor:
+            import zstandard
+            self._compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self._dict_data())
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        import zstandard
+        # Decompressors can't be shared between threads.
+        return zstandard.ZstdDecompressor(dict_data=self._dict_data()).decompress(data)
+
+
+CODECS = {codec.id: codec for codec in [LzmaCodec, ZstdCodec]}
+
+
+def codec_by_name(name):
+    return next(codec for codec in CODECS.values() if codec.name == name)
+
+
+# The codec of a version 3 freezetag, given the context of its frozen struct.
+def codec_from_context(context):
+    return CODECS[context.codec](context.dictionary)
+
+
+FrozenMetadataFormats = {
+    1: flac.FrozenMetadataFormat,
+    2: mp3.FrozenMetadataFormat,
+}
+
+# Metadata is stored as the built metadata with its blobs cut out, interleaved
+# with references to the blobs in the freezetag's block table:
+# literals[0] + blocks[0] + literals[1] + ... + literals[-1].
+FrozenChunkItemFormat = Struct(
+    'format' / Int8ub,
+    'blocks' / PrefixedArray(Int32ub, Int32ub),
+    'literals' / Array(len_(this.blocks) + 1, Prefixed(Int32ub, GreedyBytes)),
+)
+
+# The metadata of the files in a chunk, in index order, before compression.
+FrozenChunkFormat = PrefixedArray(Int32ub, FrozenChunkItemFormat)
+
+# Blocks are compressed on their own, without the dictionary, and are stored
+# uncompressed if that's smaller (e.g., for JPEG pictures).
+FrozenBlockFormat = Struct(
+    'compressed' / Flag,
+    'data' / Prefixed(Int32ub, GreedyBytes),
+)
+
+
+# Returns the uncompressed chunk made up of items, which are built with
+# FrozenChunkItemFormat.
+def join_chunk(items):
+    return Int32ub.build(len(items)) + b''.join(items)
+
+
+# Returns the total size of a frozen file's metadata. For version 3 and later,
+# this doesn't need the metadata to be decompressed.
+def frozen_metadata_len(state):
+    if 'metadata_len' in state:
+        return state.metadata_len
+    metadata = MusicMetadata.from_state(state)
+    return metadata.size if metadata else 0
+
+
+# Closes the streams that parsed containers keep as _io, which would otherwise
+# keep the whole buffer they were parsed from in memory. Workaround for
+# https://github.com/construct/construct/issues/852.
+def close_streams(obj):
+    if isinstance(obj, dict):
+        stream = obj.get('_io')
+        if stream:
+            stream.close()
+        obj = obj.values()
+    elif not isinstance(obj, list):
+        return
+    for value in obj:
+        close_streams(value)
+
+
+# Makes identical blobs in a frozen file's metadata share one bytes object with
+# those of other files. interned maps the contents of each blob to the object.
+def intern_blobs(state, interned):
+    metadata = MusicMetadata.from_state(state)
+    if not metadata:
+        return
+    for container, key in metadata.blobs():
+        blob = container[key]
+        if len(blob) >= BLOB_MIN_SIZE:
+            container[key] = interned.setdefault(blob, blob)
+
+
+# Returns the literals and blobs of a file's metadata. See FrozenChunkItemFormat.
+def split_blobs(metadata):
+    data = metadata.format.build(metadata.value)
+    literals = []
+    blobs = []
+    offset = 0
+    for container, key in metadata.blobs():
+        blob = container[key]
+        if len(blob) < BLOB_MIN_SIZE:
+            continue
+        # Blobs are yielded in the order they're built, so this finds the blob
+        # itself or an identical copy of it.
+        start = data.find(blob, offset)
+        literals.append(data[offset:start])
+        blobs.append(blob)
+        offset = start + len(blob)
+    literals.append(data[offset:])
+    return literals, blobs
+
+
+# The block table of a version 3 freezetag. Blocks are decompressed the first
+# time they're used.
+class FrozenBlocks:
+    def __init__(self, entries, codec):
+        self.entries = entries
+        self.codec = codec
+        self.blocks = [None] * len(entries)
+
+    def __getitem__(self, i):
+        block = self.blocks[i]
+        if block is None:
+            entry = self.entries[i]
+            block = self.codec.decompress(entry.data) if entry.compressed else entry.data
+            self.blocks[i] = block
+        return block
+
+
+# Assigns indexes to the blocks of a version 3 freezetag as they're added.
+# Identical blobs are only added once. on_block is called with the entry of each
+# new block. See FrozenBlockFormat.
+class FrozenBlockBuilder:
+    def __init__(self, codec, on_block):
+        self.codec = codec
+        self.on_block = on_block
+        # Keyed on the blob's SHA-1 so the blobs themselves aren't kept around.
+        self._indexes = {}
+
+    def add(self, blob):
+        key = hashlib.sha1(blob).digest()
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = len(self._indexes)
+            data = self.codec.compress(blob)
+            compressed = len(data) < len(blob)
+            self.on_block({'compressed': compressed, 'data': data if compressed else blob})
+        return index
+
+    @property
+    def count(self):
+        return len(self._indexes)
+
+
+class FrozenChunk:
+    # blocks is the freezetag's FrozenBlocks. interned is shared by the
+    # freezetag's chunks. See intern_blobs.
+    def __init__(self, data, codec, blocks, interned):
+        self.data = data
+        self.codec = codec
+        self.blocks = blocks
+        self.interned = interned
+        self.files = []
+
+    def load(self):
+        items = FrozenChunkFormat.parse(self.codec.decompress(self.data))
+        close_streams(items)
+        for file, item in zip(self.files, items):
+            file['metadata'] = self._join(item)
+            intern_blobs(file, self.interned)
+
+    def _join(self, item):
+        if item.format not in FrozenMetadataFormats:
+            return None
+        parts = [item.literals[0]]
+        for block, literal in zip(item.blocks, item.literals[1:]):
+            parts.append(self.blocks[block])
+            parts.append(literal)
+        return FrozenMetadataFormats[item.format].parse(b''.join(parts))
+
+
+# A file in a version 3 freezetag. Its metadata is decompressed along
+# with the rest of its chunk the first time it's accessed.
+class LazyFrozenFile(Container):
+    __slots__ = ['__recursion_lock__', 'chunk']
+
+    def __missing__(self, key):
+        if key != 'metadata':
+            raise KeyError(key)
+        self.chunk.load()
+        return dict.__getitem__(self, key)
+
+
+# Groups files into chunks in the order they're added. on_chunk is called with
+# the items of each chunk once it's full. See join_chunk. Blobs are added to
+# blocks, a FrozenBlockBuilder.
+class FrozenChunkBuilder:
+    def __init__(self, on_chunk, blocks):
+        self.on_chunk = on_chunk
+        self.blocks = blocks
+        self.count = 0
+        self._items = []
+        self._size = 0
+
+    def _build_item(self, file):
+        metadata = MusicMetadata.from_state(file)
+        literals, blobs = split_blobs(metadata) if metadata else ([b''], [])
+        return FrozenChunkItemFormat.build({
+            'format': file.format,
+            'blocks': [self.blocks.add(blob) for blob in blobs],
+            'literals': literals,
+        })
+
+    # Returns the index entry for file.
+    def add(self, file):
+        if not isinstance(file, Container):
+            file = Container(file)
+        item = self._build_item(file)
+        if len(self._items) >= CHUNK_MAX_FILES or (self._items and self._size + len(item) > CHUNK_MAX_SIZE):
+            self.flush()
+
+        self._items.append(item)
+        self._size += len(item)
+        return {
+            'path': file.path,
+            'format': file.format,
+            'checksum': file.checksum,
+            'stat': file.get('stat'),
+            'metadata_len': frozen_metadata_len(file),
+            'chunk': self.count,
+        }
+
+    def flush(self):
+        if self._items:
+            self.on_chunk(self._items)
+            self.count += 1
+            self._items = []
+            self._size = 0
+
+
+# Converts between the index, blocks, and chunks of version 3 and a list of
+# files like the ones in earlier versions.
+class FrozenFilesV3Adapter(Adapter):
+    def _decode(self, obj, context, path):
+        codec = codec_from_context(context)
+        blocks = FrozenBlocks(obj.blocks, CODECS[codec.id]())
+        interned = {}
+        chunks = [FrozenChunk(data, codec, blocks, interned) for data in obj.chunks]
+        files = ListContainer()
+        for entry in obj.index:
+            file = LazyFrozenFile(path=entry.path, format=entry.format, checksum=entry.checksum, stat=entry.stat,
+                                  metadata_len=entry.metadata_len)
+            file.chunk = chunks[entry.chunk]
+            file.chunk.files.append(file)
+            files.append(file)
+        return files
+
+    def _encode(self, obj, context, path):
+        codec = codec_from_context(context)
+        chunks = []
+        blocks = []
+        block_builder = FrozenBlockBuilder(CODECS[codec.id](), blocks.append)
+        builder = FrozenChunkBuilder(lambda items: chunks.append(codec.compress(join_chunk(items))), block_builder)
+        index = [builder.add(file) for file in obj]
+        builder.flush()
+        return {'index': index, 'blocks': blocks, 'chunks': chunks}
+
+
+# Index entries are in the order the files were frozen, like the file lists of
+# earlier versions, rather than sorted. Entries vary in length, so the whole index
+# is parsed either way, and lookups go through the dicts built by
+# Freezetag.file_by_checksum and file_by_path.
+FrozenIndexEntryFormat = Struct(
+    'path' / CString('utf8'),
+    'format' / Int8ub,
+    'checksum' / Bytes(20),
+    'stat' / If(this._._._.mode == 1, Struct(
+        'mtime' / Double,
+        'size' / Long,
+    )),
+    'metadata_len' / Int32ub,
+    'chunk' / Int32ub,
+)
+
+# Version 3 keeps an uncompressed index of the files, so that paths and
+# checksums can be read without decompressing any metadata, and the metadata in
+# separately compressed chunks, so that only the chunks that are needed are
+# decompressed. The chunks use the given codec (see CODECS), with an optional
+# dictionary shared by all of them. Blobs in each file's metadata (see
+# MusicMetadata.blobs) are stored once in a table of blocks and referenced by
+# index, so pictures embedded in every track of an album are only stored once.
+# Counts are 32-bit.
+FrozenFormatV3 = Struct(
+    'mode' / Int8ub,
+    'music_checksum' / Bytes(8),
+    'metadata_checksum' / Bytes(4),
+    'root' / CString('utf8'),
+    'codec' / Int8ub,
+    'dictionary' / Prefixed(Int32ub, GreedyBytes),
+    'files' / FrozenFilesV3Adapter(Struct(
+        'index' / PrefixedArray(Int32ub, FrozenIndexEntryFormat),
+        'blocks' / PrefixedArray(Int32ub, FrozenBlockFormat),
+        'chunks' / PrefixedArray(Int32ub, Prefixed(Int32ub, GreedyBytes)),
+    )),
 )
 
 FreezeFormat = Struct(
@@ -55,90 +436,275 @@ FreezeFormat = Struct(
     'frozen' / Switch(this.version, {
         1: FrozenFormatV1,
         2: FrozenFormatV2,
+        3: FrozenFormatV3,
     }, GreedyBytes),
     Terminated,
 )
 
+# The fields of FreezeFormat that precede the compressed file list, which can be
+# read without decompressing it.
+FreezeHeaderFormat = Struct(
+    'signature' / Const(b'freezetag'),
+    'version' / Int8ub,
+    'frozen' / Switch(this.version, {
+        1: Struct(
+            'mode' / Computed(0),
+            'music_checksum' / Bytes(8),
+            'metadata_checksum' / Bytes(4),
+            'root' / CString('utf8'),
+        ),
+        2: Struct(
+            'mode' / Int8ub,
+            'music_checksum' / Bytes(8),
+            'metadata_checksum' / Bytes(4),
+            'root' / CString('utf8'),
+        ),
+        3: Struct(
+            'mode' / Int8ub,
+            'music_checksum' / Bytes(8),
+            'metadata_checksum' / Bytes(4),
+            'root' / CString('utf8'),
+            'codec' / Int8ub,
+            'dictionary' / Prefixed(Int32ub, GreedyBytes),
+        ),
+    }),
+)
+
+MetadataInfoFormat = PrefixedArray(Int8ub, Struct(
+    'type' / CString('ascii'),
+    'size' / Int32ub,
+))
+
+# Tables of ChecksumDB holding mount snapshots, besides the snapshots table itself.
+SNAPSHOT_TABLES = ['snapshot_freezetags', 'snapshot_entries', 'snapshot_files', 'snapshot_metadata_info']
+
+# Format of the version 1 database, which is only read to migrate it.
 DBItemFormat = Struct(
     'device' / Int32ub,
     'inode' / Int64ub,
     'mtime' / Double,
     'checksum' / Bytes(20),
     'metadata_len' / Int32ub,
-    'metadata_info' / PrefixedArray(Int8ub, Struct(
-        'type' / CString('ascii'),
-        'size' / Int32ub,
-    )),
+    'metadata_info' / MetadataInfoFormat,
 )
 
 DBFormat = Struct(
-    'version' / Const(DB_VERSION, Int8ub),
+    'version' / Const(1, Int8ub),
     'entries' / GreedyRange(DBItemFormat),
 )
 
 
-class ChecksumDBAdapter(Adapter):
-    def _decode(self, obj, context, path):
-        dict = {}
-        for item in obj.entries:
-            if item.device not in dict:
-                dict[item.device] = {}
-            metadata_info = [(m.type, m.size) for m in item.metadata_info]
-            dict[item.device][item.inode] = (item.checksum, metadata_info, item.metadata_len, item.mtime)
-        return dict
+# A persistent cache of file checksums keyed on device, inode, size, and mtime,
+# backed by SQLite and shared by all commands. The database is in WAL mode, so
+# several processes can use it at once, and each add() is committed immediately.
+#
+# It also holds the snapshot of each mounted directory (see save_snapshot).
+# Paths of files in those directories are stored as the bytes the OS uses for
+# them, since they aren't necessarily valid UTF-8.
+class ChecksumDB:
+    def __init__(self, path=CACHE_DIR / 'checksums.db', legacy_path=CACHE_DIR / 'freezefs.db'):
+        self.path = path
+        self._lock = Lock()
 
-    def _encode(self, obj, context, path):
-        entries = []
-        for device, inodes in obj.items():
-            for inode, (checksum, metadata_info, metadata_len, mtime) in inodes.items():
-                entries.append({
-                    'device': device,
-                    'inode': inode,
-                    'mtime': mtime,
-                    'checksum': checksum,
-                    'metadata_len': metadata_len,
-                    'metadata_info': [{'type': m[0], 'size': m[1]} for m in metadata_info],
-                })
+        path.parent.mkdir(parents=True, exist_ok=True)
+        exists = path.exists()
+        self._conn = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
 
-        return {'version': DB_VERSION, 'entries': entries}
+        with self._conn:
+            # Taking the write lock up front keeps other processes from creating
+            # the table at the same time.
+            self._conn.execute('BEGIN IMMEDIATE')
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != DB_VERSION:
+                self._conn.execute('DROP TABLE IF EXISTS files')
+                self._conn.execute('CREATE TABLE files (device INTEGER, inode INTEGER, size INTEGER, mtime REAL, '
+                                   'checksum BLOB, metadata_len INTEGER, metadata_info BLOB, metadata_checksum BLOB, '
+                                   'path TEXT, PRIMARY KEY (device, inode))')
+                self._conn.execute(f'PRAGMA user_version={DB_VERSION}')
 
+            # The snapshot tables have their own version (see save_snapshot), so they
+            # aren't dropped along with the checksums.
+            self._conn.execute('CREATE TABLE IF NOT EXISTS snapshots (directory BLOB PRIMARY KEY, version INTEGER)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS snapshot_freezetags (directory BLOB, path BLOB, root TEXT, '
+                               'mtime REAL, size INTEGER, expanded INTEGER)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS snapshot_entries (directory BLOB, freezetag_path BLOB, '
+                               'checksum BLOB, path TEXT, metadata_len INTEGER)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS snapshot_files (directory BLOB, path BLOB, checksum BLOB, '
+                               'metadata_len INTEGER, mtime REAL, size INTEGER)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS snapshot_metadata_info (directory BLOB, path BLOB, '
+                               'type TEXT, size INTEGER)')
+            for table in SNAPSHOT_TABLES:
+                self._conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_directory ON {table} (directory)')
 
-class ChecksumDB:
-    def __init__(self, path):
-        self.path = path
-        self._flush_counter = 0
-        self._format = ChecksumDBAdapter(DBFormat)
+        # Whether the database was reused rather than created.
+        self.existed = exists and version == DB_VERSION
+
+        if legacy_path and legacy_path.exists():
+            self._migrate(legacy_path)
+
+    def _migrate(self, legacy_path):
         try:
-            self._db = self._format.parse_file(str(path))
-            print(f'using existing database {path}')
+            entries = DBFormat.parse_file(str(legacy_path)).entries
         except:
-            print(f'creating database at {path}')
-            self._db = {}
-
-    def get(self, device, inode, mtime):
-        dict = self._db.get(device)
-        if not dict:
-            return
-        item = dict.get(inode)
-        if not item or item[3] != mtime:
+            print(f'cannot parse database: {legacy_path}')
             return
-        return item
 
-    def add(self, device, inode, mtime, checksum, metadata_info, metadata_len):
-        if device not in self._db:
-            self._db[device] = {}
-        self._db[device][inode] = (checksum, metadata_info, metadata_len, mtime)
-        self._try_flush()
+        print(f'migrating database {legacy_path}')
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            # Sizes and paths weren't stored, so they're filled in by get() as files are seen.
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO files VALUES (?, ?, NULL, ?, ?, ?, ?, NULL, NULL)',
+                ((e.device, e.inode, e.mtime, e.checksum, e.metadata_len, MetadataInfoFormat.build(e.metadata_info))
+                 for e in entries))
 
-    def _try_flush(self):
-        self._flush_counter += 1
-        if self._flush_counter < 50:
+        try:
+            legacy_path.unlink()
+        except FileNotFoundError:
+            # Migrated by another process.
+            pass
+
+    # Returns (checksum, metadata_info, metadata_len, metadata_checksum) for the
+    # file at path with stat result st, or None if it isn't cached.
+    # metadata_checksum may be None for music files cached by older versions.
+    def get(self, path, st):
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime, checksum, metadata_len, metadata_info, metadata_checksum, '
+                                     'path FROM files WHERE device = ? AND inode = ?',
+                                     (st.st_dev, st.st_ino)).fetchone()
+        if not row or row[0] not in (None, st.st_size) or row[1] != st.st_mtime:
             return
-        self.flush()
 
-    def flush(self):
-        self._flush_counter = 0
-        self._format.build_file(self._db, str(self.path))
+        # Fill in the path so compact() can tell whether the entry is stale. Any
+        # existing path of the file will do, so hardlinks don't each rewrite it.
+        if row[0] is None or row[6] is None or (row[6] != str(path) and not os.path.lexists(row[6])):
+            with self._lock:
+                self._conn.execute('UPDATE files SET size = ?, path = ? WHERE device = ? AND inode = ?',
+                                   (st.st_size, str(path), st.st_dev, st.st_ino))
+
+        metadata_info = [(m.type, m.size) for m in MetadataInfoFormat.parse(row[4])]
+        return (row[2], metadata_info, row[3], row[5])
+
+    def add(self, path, st, checksum, metadata_info, metadata_len, metadata_checksum):
+        metadata_info = MetadataInfoFormat.build([{'type': m[0], 'size': m[1]} for m in metadata_info])
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (st.st_dev, st.st_ino, st.st_size, st.st_mtime, checksum, metadata_len,
+                                metadata_info, metadata_checksum, str(path)))
+
+    # Drops entries for files under directory that no longer exist or have
+    # changed since they were added. Entries migrated from the old database are
+    # kept until their path is known.
+    #
+    # The database is shared by every directory, so only entries under directory
+    # are checked, and nothing is dropped if directory itself is missing (e.g.,
+    # it's on a drive that isn't mounted).
+    def compact(self, directory):
+        directory = os.path.join(os.path.abspath(directory), '')
+        if not os.path.isdir(directory):
+            return 0
+
+        with self._lock:
+            rows = self._conn.execute('SELECT device, inode, size, mtime, path FROM files '
+                                      'WHERE substr(path, 1, ?) = ?', (len(directory), directory)).fetchall()
+
+        stale = []
+        for row in rows:
+            device, inode, size, mtime, path = row
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stale.append(row)
+                continue
+            except OSError:
+                # Might only be unreadable for now.
+                continue
+            if (st.st_dev, st.st_ino, st.st_size, st.st_mtime) != (device, inode, size, mtime):
+                stale.append(row)
+
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            # Matching on all columns keeps entries that were updated in the meantime.
+            self._conn.executemany('DELETE FROM files WHERE device = ? AND inode = ? AND size = ? AND mtime = ? '
+                                   'AND path = ?', stale)
+        return len(stale)
+
+    # Replaces the snapshot of the mounted directory. freezetags is a list of
+    # (path, root, mtime, size, expanded), entries a list of
+    # (freezetag path, checksum, mounted path, metadata_len), and files a list of
+    # (path, checksum, metadata_info, metadata_len, mtime, size).
+    def save_snapshot(self, directory, version, freezetags, entries, files):
+        directory = os.fsencode(directory)
+        with self._lock, self._conn:
+            self._conn.execute('BEGIN')
+            for table in ['snapshots'] + SNAPSHOT_TABLES:
+                self._conn.execute(f'DELETE FROM {table} WHERE directory = ?', (directory,))
+            self._conn.execute('INSERT INTO snapshots VALUES (?, ?)', (directory, version))
+            self._conn.executemany('INSERT INTO snapshot_freezetags VALUES (?, ?, ?, ?, ?, ?)', (
+                (directory, os.fsencode(path), root, mtime, size, expanded)
+                for path, root, mtime, size, expanded in freezetags))
+            self._conn.executemany('INSERT INTO snapshot_entries VALUES (?, ?, ?, ?, ?)', (
+                (directory, os.fsencode(freezetag_path), checksum, path, metadata_len)
+                for freezetag_path, checksum, path, metadata_len in entries))
+            self._conn.executemany('INSERT INTO snapshot_files VALUES (?, ?, ?, ?, ?, ?)', (
+                (directory, os.fsencode(path), checksum, metadata_len, mtime, size)
+                for path, checksum, metadata_info, metadata_len, mtime, size in files))
+            # Kept out of snapshot_files since building and parsing MetadataInfoFormat
+            # for every file is much slower than reading the rows.
+            self._conn.executemany('INSERT INTO snapshot_metadata_info VALUES (?, ?, ?, ?)', (
+                (directory, os.fsencode(f[0]), type, size) for f in files for type, size in f[2]))
+
+    # Returns the (freezetags, entries, files) saved by save_snapshot() in the order
+    # they were saved, or None if there's no snapshot of the directory with the
+    # given version.
+    def load_snapshot(self, directory, version):
+        directory = os.fsencode(directory)
+        with self._lock, self._conn:
+            # Read in one transaction so a snapshot being saved isn't seen halfway.
+            self._conn.execute('BEGIN')
+            row = self._conn.execute('SELECT version FROM snapshots WHERE directory = ?', (directory,)).fetchone()
+            if not row or row[0] != version:
+                return None
+            freezetags = self._conn.execute('SELECT path, root, mtime, size, expanded FROM snapshot_freezetags '
+                                            'WHERE directory = ? ORDER BY rowid', (directory,)).fetchall()
+            entries = self._conn.execute('SELECT freezetag_path, checksum, path, metadata_len FROM snapshot_entries '
+                                         'WHERE directory = ? ORDER BY rowid', (directory,)).fetchall()
+            files = self._conn.execute('SELECT path, checksum, metadata_len, mtime, size FROM snapshot_files '
+                                       'WHERE directory = ? ORDER BY rowid', (directory,)).fetchall()
+            metadata_rows = self._conn.execute('SELECT path, type, size FROM snapshot_metadata_info '
+                                               'WHERE directory = ? ORDER BY rowid', (directory,)).fetchall()
+
+        metadata_info = {}
+        for path, type, size in metadata_rows:
+            metadata_info.setdefault(path, []).append((type, size))
+
+        freezetags = [(os.fsdecode(path), root, mtime, size, bool(expanded))
+                      for path, root, mtime, size, expanded in freezetags]
+        entries = [(os.fsdecode(freezetag_path), checksum, path, metadata_len)
+                   for freezetag_path, checksum, path, metadata_len in entries]
+        files = [(os.fsdecode(path), checksum, metadata_info.get(path, []), metadata_len, mtime, size)
+                 for path, checksum, metadata_len, mtime, size in files]
+        return freezetags, entries, files
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# checksum is the SHA-1 of the entire freezetag file.
+def make_id(music_checksum, metadata_checksum, checksum):
+    return 'F' + '-'.join([music_checksum.hex(), metadata_checksum.hex(), checksum[0:4].hex()])
+
+
+# Builds a single frozen file or index entry. Their stat fields are looked up in
+# the freezetag `depth` contexts up, so a context holding mode is nested to match.
+def build_frozen_file(format, file, mode, depth):
+    context = Container(mode=mode)
+    for _ in range(depth - 1):
+        context = Container(_=context)
+    return format.build(file, **context)
 
 
 class Freezetag:
@@ -147,6 +713,12 @@ class Freezetag:
         data = FreezeFormat.parse(b)
         # Workaround for https://github.com/construct/construct/issues/852
         data._io.close()
+        if data.version < 3:
+            # Later versions do this as their chunks are loaded.
+            close_streams(data.frozen.files)
+            interned = {}
+            for f in data.frozen.files:
+                intern_blobs(f, interned)
         freezetag = Freezetag(data)
         freezetag._bytes = b
         return freezetag
@@ -156,13 +728,43 @@ class Freezetag:
         with path.open('rb') as f:
             return Freezetag.from_bytes(f.read())
 
+    # Reads only the header of the freezetag at path. See FreezeHeaderFormat.
+    @staticmethod
+    def header_from_path(path):
+        with path.open('rb') as f:
+            header = FreezeHeaderFormat.parse_stream(f)
+        if not header.frozen:
+            raise ValueError(f'unsupported freezetag version: {header.version}')
+        return header
+
     def __init__(self, data):
         self.data = data
         self._bytes = None
+        self._checksum_index = None
+        self._path_index = None
 
     # Call this manually if data is changed.
     def data_updated(self):
         self._bytes = None
+        self._checksum_index = None
+        self._path_index = None
+
+    # Returns the first frozen file with the given checksum, or None. The index is
+    # built on the first lookup, since most freezetags are only listed.
+    def file_by_checksum(self, checksum):
+        if self._checksum_index is None:
+            index = {}
+            for f in self.data.frozen.files:
+                index.setdefault(f.checksum, f)
+            self._checksum_index = index
+        return self._checksum_index.get(checksum)
+
+    # Returns the frozen file with the given path (relative to the root), or None.
+    def file_by_path(self, path):
+        if self._path_index is None:
+            self._path_index = {f.path: f for f in self.data.frozen.files}
+        # Frozen paths are POSIX, whatever the platform.
+        return self._path_index.get(pathlib.PurePath(path).as_posix())
 
     def bytes(self):
         if not self._bytes:
@@ -170,11 +772,176 @@ class Freezetag:
         return self._bytes
 
     def get_id(self):
-        checksum = hashlib.sha1(self.bytes()).digest()[0:4]
-        return 'F' + '-'.join([self.data['frozen']['music_checksum'].hex(),
-                               self.data['frozen']['metadata_checksum'].hex(),
-                               checksum.hex()])
+        return make_id(self.data['frozen']['music_checksum'], self.data['frozen']['metadata_checksum'],
+                       hashlib.sha1(self.bytes()).digest())
 
     def write(self, path):
         with path.open('wb') as f:
             f.write(self.bytes())
+
+
+# Writes a freezetag one file at a time, so that memory use doesn't grow with the
+# number of files. The file list is compressed (or, for version 3, chunked) as
+# files are added, and the checksums in the header are filled in by finish().
+#
+# The freezetag is written to a temporary file in `directory`, and write() then
+# moves it into place. count is the number of files that will be added, which
+# precedes the files themselves. codec and train_dictionary only apply to
+# version 3. If train_dictionary is True, the codec's dictionary is trained on
+# the metadata of the first files, which are held in memory until then.
+class FreezetagWriter:
+    def __init__(self, directory, version, mode, root, count, codec=None, train_dictionary=False):
+        self.version = version
+        self.mode = mode
+        self.root = root
+        self.codec = codec or LzmaCodec()
+        self.expected_count = count
+        self.count = 0
+        self.music_checksums = []
+        self.metadata_checksums = []
+        self.music_checksum = bytes(8)
+        self.metadata_checksum = bytes(4)
+        self._train_dictionary = train_dictionary
+        self._pending_chunks = []
+        self._pending_size = 0
+        self._compressor = None
+        self._index = None
+        self._blocks = None
+        self._chunks = None
+
+        if version < 3 and (self.codec.id != LzmaCodec.id or train_dictionary):
+            raise ValueError(f'version {version} freezetags can only use lzma')
+
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.ftag.tmp')
+        self.file = os.fdopen(fd, 'w+b')
+        try:
+            if version >= 3:
+                # The header is written by finish(), since the dictionary isn't
+                # known until then.
+                self._index = tempfile.TemporaryFile()
+                self._blocks = tempfile.TemporaryFile()
+                self._chunks = tempfile.TemporaryFile()
+                block_builder = FrozenBlockBuilder(CODECS[self.codec.id](), self._write_block)
+                self._chunk_builder = FrozenChunkBuilder(self._add_chunk, block_builder)
+            else:
+                self.file.write(self._header())
+                self._compressor = lzma.LZMACompressor()
+                self.file.write(self._compressor.compress(Int16ub.build(count)))
+        except BaseException:
+            self.discard()
+            raise
+
+    def _header(self):
+        return FreezeHeaderFormat.build({
+            'signature': b'freezetag',
+            'version': self.version,
+            'frozen': {
+                'mode': self.mode,
+                'music_checksum': self.music_checksum,
+                'metadata_checksum': self.metadata_checksum,
+                'root': self.root,
+                'codec': self.codec.id,
+                'dictionary': self.codec.dictionary,
+            },
+        })
+
+    def _add_chunk(self, items):
+        if not self._train_dictionary:
+            self._write_chunk(items)
+            return
+
+        self._pending_chunks.append(items)
+        self._pending_size += sum(len(item) for item in items)
+        if self._pending_size >= DICTIONARY_SAMPLE_SIZE:
+            self._write_pending_chunks()
+
+    def _write_pending_chunks(self):
+        self.codec.train([item for items in self._pending_chunks for item in items])
+        self._train_dictionary = False
+        for items in self._pending_chunks:
+            self._write_chunk(items)
+        self._pending_chunks = []
+
+    def _write_block(self, entry):
+        self._blocks.write(FrozenBlockFormat.build(entry))
+
+    def _write_chunk(self, items):
+        data = self.codec.compress(join_chunk(items))
+        self._chunks.write(Int32ub.build(len(data)))
+        self._chunks.write(data)
+
+    # metadata_checksum is the checksum of the file's metadata, or None.
+    def add(self, file, metadata_checksum):
+        if file['format']:
+            self.music_checksums.append(file['checksum'])
+            self.metadata_checksums.append(metadata_checksum)
+
+        if self.version >= 3:
+            entry = self._chunk_builder.add(file)
+            self._index.write(build_frozen_file(FrozenIndexEntryFormat, entry, self.mode, 3))
+        elif self.version == 2:
+            self.file.write(self._compressor.compress(build_frozen_file(FrozenFileV2Format, file, self.mode, 2)))
+        else:
+            self.file.write(self._compressor.compress(FrozenFileV1Format.build(file)))
+        self.count += 1
+
+    def finish(self):
+        if self.count != self.expected_count:
+            raise ValueError(f'expected {self.expected_count} files, got {self.count}')
+
+        self.music_checksum = hashlib.sha1(b''.join(sorted(self.music_checksums))).digest()[0:8]
+        self.metadata_checksum = hashlib.sha1(b''.join(sorted(self.metadata_checksums))).digest()[0:4]
+
+        if self.version >= 3:
+            self._chunk_builder.flush()
+            if self._train_dictionary:
+                self._write_pending_chunks()
+
+            self.file.write(self._header())
+            self.file.write(Int32ub.build(self.count))
+            self._index.seek(0)
+            shutil.copyfileobj(self._index, self.file)
+            self.file.write(Int32ub.build(self._chunk_builder.blocks.count))
+            self._blocks.seek(0)
+            shutil.copyfileobj(self._blocks, self.file)
+            self.file.write(Int32ub.build(self._chunk_builder.count))
+            self._chunks.seek(0)
+            shutil.copyfileobj(self._chunks, self.file)
+            for f in [self._index, self._blocks, self._chunks]:
+                if f:
+                    f.close()
+        else:
+            self.file.write(self._compressor.flush())
+            self.file.seek(0)
+            self.file.write(self._header())
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # Only valid after finish().
+    def get_id(self):
+        checksum = hashlib.sha1()
+        self.file.seek(0)
+        for b in iter(lambda: self.file.read(1024 * 1024), b''):
+            checksum.update(b)
+        return make_id(self.music_checksum, self.metadata_checksum, checksum.digest())
+
+    # Moves the finished freezetag to path.
+    def write(self, path):
+        self.file.close()
+        # mkstemp only gives the owner access.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.path, 0o666 & ~umask)
+        os.replace(self.path, path)
+        self.path = None
+
+    # Deletes the temporary file if the freezetag wasn't written.
+    def discard(self):
+        self.file.close()
+        for f in [self._index, self._blocks, self._chunks]:
+            if f:
+                f.close()
+        if self.path:
+            os.unlink(self.path)
+            self.path = None
@@ -0,0 +1,188 @@
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # Windows.
+    fcntl = None
+
+# Size of the reusable buffer used when streaming file contents.
+CHUNK_SIZE = 1024 * 1024
+
+# ioctl request to share all extents of a file with another file (btrfs, XFS).
+FICLONE = 0x40049409
+
+LINK_MODES = ['copy', 'reflink', 'hardlink', 'auto']
+
+
+def stream_size(stream):
+    offset = stream.tell()
+    size = stream.seek(0, 2)
+    stream.seek(offset, 0)
+    return size
+
+
+# A region list describes the bytes of a (possibly virtual) file as a sequence
+# of parts. Each part is either a bytes-like object, which is used as-is, or an
+# (offset, length) tuple referencing a byte range of a source file on disk.
+def iter_regions(path, regions):
+    with open(path, 'rb', buffering=0) as f:
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        for region in regions:
+            if not isinstance(region, tuple):
+                yield region
+                continue
+
+            offset, length = region
+            f.seek(offset, 0)
+            while length > 0:
+                n = f.readinto(view[:min(length, CHUNK_SIZE)])
+                if not n:
+                    raise EOFError(f'unexpected end of file: {path}')
+                # The view is only valid until the next chunk is read.
+                yield view[:n]
+                length -= n
+
+
+def hash_regions(path, regions):
+    sha1 = hashlib.sha1()
+    for chunk in iter_regions(path, regions):
+        sha1.update(chunk)
+    return sha1.digest()
+
+
+def write_regions(path, regions, to_path):
+    to_path = str(to_path)
+
+    # Writing over the source file would clobber the byte ranges being copied,
+    # so write to a temporary file next to it and swap it in afterwards.
+    if os.path.exists(to_path) and os.path.samefile(path, to_path):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(to_path), prefix='.', suffix='.freezetag-tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                _write_regions(path, regions, f)
+            shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, to_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return
+
+    with open(to_path, 'wb') as f:
+        _write_regions(path, regions, f)
+
+
+def _write_regions(path, regions, f):
+    with open(path, 'rb', buffering=0) as src:
+        for region in regions:
+            if not isinstance(region, tuple):
+                f.write(region)
+                continue
+
+            # The byte range is copied by the kernel, bypassing f's buffer.
+            f.flush()
+            copy_range(src, f, *region)
+
+
+# Set to False once a copy mechanism turns out to be unsupported on this system.
+_copy_file_range_supported = hasattr(os, 'copy_file_range')
+_sendfile_supported = hasattr(os, 'sendfile')
+
+
+# Copies length bytes starting at offset in src to the current position of dst.
+# Both must be unbuffered or flushed file objects. The data is copied in-kernel
+# with copy_file_range() or sendfile() if possible (which may share extents on
+# filesystems that support it), falling back to a buffered copy otherwise.
+def copy_range(src, dst, offset, length):
+    global _copy_file_range_supported, _sendfile_supported
+
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+
+    while length > 0 and _copy_file_range_supported:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, min(length, 1 << 30), offset)
+        except OSError as e:
+            if e.errno in (errno.ENOSYS, errno.EOPNOTSUPP, errno.EPERM):
+                _copy_file_range_supported = False
+            elif e.errno not in (errno.EXDEV, errno.EINVAL):
+                raise
+            break
+        if not n:
+            raise EOFError(f'unexpected end of file: {src.name}')
+        offset += n
+        length -= n
+
+    while length > 0 and _sendfile_supported:
+        try:
+            n = os.sendfile(dst_fd, src_fd, offset, min(length, 1 << 30))
+        except OSError as e:
+            if e.errno in (errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP, errno.EPERM):
+                _sendfile_supported = False
+            elif e.errno not in (errno.EXDEV, errno.EINVAL):
+                raise
+            break
+        if not n:
+            raise EOFError(f'unexpected end of file: {src.name}')
+        offset += n
+        length -= n
+
+    if length > 0:
+        src.seek(offset, 0)
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        while length > 0:
+            n = src.readinto(view[:min(length, CHUNK_SIZE)])
+            if not n:
+                raise EOFError(f'unexpected end of file: {src.name}')
+            dst.write(view[:n])
+            length -= n
+        dst.flush()
+
+
+# Creates to_path with the same contents as path according to mode:
+#   copy      copies the data (shutil.copy2).
+#   reflink   clones the data's extents, failing if the filesystem can't.
+#   hardlink  hardlinks to_path to path, failing if it can't. Both paths will
+#             then refer to the same file, so changes to one affect the other.
+#   auto      reflinks if possible, and copies otherwise.
+def link_file(path, to_path, mode='copy'):
+    if os.path.exists(to_path):
+        if os.path.samefile(path, to_path):
+            raise shutil.SameFileError(f'{path} and {to_path} are the same file')
+        if mode != 'copy':
+            os.unlink(to_path)
+
+    if mode in ('reflink', 'auto'):
+        try:
+            reflink(path, to_path)
+            return
+        except OSError:
+            if mode == 'reflink':
+                raise
+
+    if mode == 'hardlink':
+        os.link(path, to_path)
+        return
+
+    shutil.copy2(path, to_path)
+
+
+def reflink(path, to_path):
+    if not fcntl or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported on this platform', str(path))
+
+    with open(path, 'rb') as src:
+        try:
+            with open(to_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except BaseException:
+            os.unlink(to_path)
+            raise
+    shutil.copystat(path, to_path)
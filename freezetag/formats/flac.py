@@ -1,4 +1,6 @@
-from freezetag import base
+import os
+
+from freezetag import base, fileio
 from construct import *
 
 
@@ -12,6 +14,9 @@ BLOCK_TYPES = [
     'PICTURE',
 ]
 
+PADDING = BLOCK_TYPES.index('PADDING')
+MAX_BLOCK_SIZE = 2**24 - 1
+
 MetadataFormat = Struct(
     'info' / BitStruct(
         'last' / Flag,
@@ -23,10 +28,16 @@ MetadataFormat = Struct(
 
 FrozenMetadataFormat = PrefixedArray(Int8ub, MetadataFormat)
 
-Format = Struct(
+HeaderFormat = Struct(
     'signature' / Const(b'fLaC'),
     'metadata' / RepeatUntil(lambda metadata, *_: metadata.info.last, MetadataFormat),
-    'audio' / GreedyBytes,
+)
+
+# The audio frames are not read into memory. They're referenced by audio_offset
+# and audio_len so that they can be streamed from the source file.
+Format = HeaderFormat + Struct(
+    'audio_offset' / Tell,
+    'audio_len' / Computed(lambda this: fileio.stream_size(this._io) - this.audio_offset),
 )
 
 
@@ -38,6 +49,10 @@ class MusicMetadata(base.MusicMetadata):
         for item in self.value:
             yield BLOCK_TYPES[item.info.block_type], item.size + 4
 
+    def blobs(self):
+        for item in self.value:
+            yield item, 'data'
+
 
 class ParsedFile(base.MusicParsedFile):
     def __init__(self, path):
@@ -57,48 +72,71 @@ class ParsedFile(base.MusicParsedFile):
         self.instance.metadata[0].info.last = not len(metadata)
         self.instance.metadata += metadata
 
+    def regions(self):
+        return [HeaderFormat.build(self.instance), (self.instance.audio_offset, self.instance.audio_len)]
+
+    def write(self, path, padding=False):
+        if not self._write_in_place(path, padding):
+            super().write(path)
+
+    # Overwrites the metadata blocks of the source file directly, leaving the
+    # audio frames untouched. This only works if the new metadata takes up exactly
+    # as much space as the old one, or, if padding is True, if it's small enough
+    # that the rest of the space can be filled with PADDING blocks. Returns
+    # whether the file was written.
+    def _write_in_place(self, path, padding):
+        if not os.path.exists(path) or not os.path.samefile(self.path, path):
+            return False
+
+        metadata = [Container(m) for m in self.instance.metadata]
+        gap = self.instance.audio_offset - len(HeaderFormat.build(self.instance))
+
+        if gap and (not padding or gap < 4):
+            return False
+
+        while gap:
+            # Never leave less than a block header's worth of space for the next block.
+            size = gap - 4 if gap - 4 <= MAX_BLOCK_SIZE else MAX_BLOCK_SIZE - 4
+            metadata.append(Container(info=Container(last=True, block_type=PADDING), size=size, data=bytes(size)))
+            gap -= size + 4
+
+        for i, m in enumerate(metadata):
+            m.info = Container(m.info, last=i == len(metadata) - 1)
+
+        header = HeaderFormat.build({'signature': b'fLaC', 'metadata': metadata})
+        assert len(header) == self.instance.audio_offset
+
+        with open(path, 'r+b') as f:
+            f.write(header)
+        return True
+
 
 class FuseFile(base.FuseFile):
     def __init__(self, file_path, flags, metadata, file_metadata_info, file_metadata_len, frozen_metadata_len):
         super().__init__(file_path, flags, metadata, file_metadata_info, file_metadata_len, frozen_metadata_len)
         self.file_metadata_len = file_metadata_len
         self.frozen_metadata_len = frozen_metadata_len
+        self._head_bytes = None
         self._metadata_bytes = None
 
+    # The signature and STREAMINFO block, whose last flag depends on whether any
+    # frozen metadata follows it.
+    def head_bytes(self):
+        if self._head_bytes == None:
+            head = bytearray(self._pread(42, 0))
+            head[4] = head[4] & 0x7f | (0 if self.frozen_metadata_len else 0x80)
+            self._head_bytes = bytes(head)
+        return self._head_bytes
+
     def metadata_bytes(self):
         if self._metadata_bytes == None:
             self._metadata_bytes = b''.join(MetadataFormat.build(m) for m in self.metadata)
         return self._metadata_bytes
 
-    def read(self, length, offset):
-        f = self.file
-        buf = b''
-
-        if offset < 42:
-            f.seek(0, 0)
-            head = f.read(42)
-            if head[4] >= 128:
-                head = head[0:4] + bytes([head[4] - 128]) + head[5:]
-            end = min(42, offset + length)
-            buf = head[offset:end]
-            length -= len(buf)
-            if not length:
-                return buf
-            offset = 42
-        offset -= 42
-
-        metadata_len = self.frozen_metadata_len
-        if offset < metadata_len:
-            metadata_bytes = self.metadata_bytes()
-            end = min(metadata_len, offset + length)
-            tmp = metadata_bytes[offset:end]
-            length -= len(tmp)
-            buf += tmp
-            if not length:
-                return buf
-            offset = metadata_len
-        offset -= metadata_len
-
-        offset += 42 + self.file_metadata_len
-        f.seek(offset, 0)
-        return buf + f.read(length)
+    def segments(self):
+        audio_offset = 42 + self.file_metadata_len
+        return [
+            (42, self.head_bytes),
+            (self.frozen_metadata_len, self.metadata_bytes),
+            (self.file_size - audio_offset, audio_offset),
+        ]
@@ -1,4 +1,3 @@
-import hashlib
 from construct import *
 from freezetag import base
 
@@ -8,8 +7,8 @@ class ParsedFile(base.ParsedFile):
         super().__init__(path, None)
 
     def parse(self):
-        with self.path.open('rb') as f:
-            return f.read()
+        # The contents are never read into memory; they're streamed when hashed.
+        return Container(size=self.path.stat().st_size)
 
     def strip(self):
         return None
@@ -17,11 +16,10 @@ class ParsedFile(base.ParsedFile):
     def restore_metadata(self, metadata):
         pass
 
-    def checksum(self):
-        return hashlib.sha1(self.instance).digest()
+    def regions(self):
+        return [(0, self.instance.size)]
 
 
 class FuseFile(base.FuseFile):
-    def read(self, length, offset):
-        self.file.seek(offset, 0)
-        return self.file.read(length)
+    def segments(self):
+        return [(self.file_size, 0)]
@@ -1,4 +1,4 @@
-from freezetag import base
+from freezetag import base, fileio
 from construct import *
 
 
@@ -48,30 +48,29 @@ Id3v2Format = Struct(
     'size' / Computed(lambda this: this.header.size + 10 + (10 if this.footer else 0)),
 )
 
-class FormatAdapter(Adapter):
-    def _decode(self, obj, context, path):
-        return Struct(
-            'id3v2_head' / Optional(Id3v2Format),
-            'offset' / Tell,
-            'try_id3v1' / Pointer(-128, Optional(RawCopy(Id3v1Format))),
-            'try_id3v2' / Pointer(-138 if this.try_id3v1 else -10, Optional(RawCopy(Id3v2HeaderFormat))),
-            'audio' / IfThenElse(this.try_id3v2, Bytes(this.try_id3v2.offset1 - this.try_id3v2.size - 10 - this.offset),
-                                 IfThenElse(this.try_id3v1, Bytes(this.try_id3v1.offset1 - this.offset), GreedyBytes)),
-            'id3v2_tail' / If(this.try_id3v2, Id3v2Format),
-            'id3v1' / If(this.try_id3v1, Id3v1Format),
-            Terminated,
-        ).parse(obj)
-
-    def _encode(self, obj, context, path):
-        return Struct(
-            'id3v2_head' / Optional(Id3v2Format),
-            'audio' / GreedyBytes,
-            'id3v2_tail' / Optional(Id3v2Format),
-            'id3v1' / Optional(Id3v1Format),
-            Terminated,
-        ).build(obj)
-
-Format = FormatAdapter(GreedyBytes)
+# Only the tags are read into memory. The audio is referenced by audio_offset and
+# audio_len so that it can be streamed from the source file.
+#
+# Note that the ID3v2 footer is always looked for 138 bytes from the end (i.e.,
+# in front of an ID3v1 tag), and that the trailing tags are looked for at the
+# start of files shorter than that. Checksums of existing freezetags depend on
+# this, so it must not change.
+Format = Struct(
+    'file_size' / Computed(lambda this: fileio.stream_size(this._io)),
+    'id3v2_head' / Optional(Id3v2Format),
+    'audio_offset' / Tell,
+    'try_id3v1' / Pointer(lambda this: -min(128, this.file_size), Optional(RawCopy(Id3v1Format))),
+    'try_id3v2' / Pointer(lambda this: -min(138, this.file_size), Optional(RawCopy(Id3v2HeaderFormat))),
+    'audio_len' / IfThenElse(this.try_id3v2,
+                             Computed(this.try_id3v2.offset1 - this.try_id3v2.size - 10 - this.audio_offset),
+                             IfThenElse(this.try_id3v1, Computed(this.try_id3v1.offset1 - this.audio_offset),
+                                        Computed(this.file_size - this.audio_offset))),
+    Check(this.audio_len >= 0),
+    Seek(this.audio_offset + this.audio_len),
+    'id3v2_tail' / If(this.try_id3v2, Id3v2Format),
+    'id3v1' / If(this.try_id3v1, Id3v1Format),
+    Terminated,
+)
 
 FrozenMetadataFormat = Struct(
     'flags' / BitStruct(
@@ -100,6 +99,12 @@ class MusicMetadata(base.MusicMetadata):
         if self.value['flags']['has_id3v1']:
             yield 'ID3v1', 128
 
+    def blobs(self):
+        for key in ['id3v2_head', 'id3v2_tail']:
+            if self.value[key]:
+                for frame in self.value[key].body.frames:
+                    yield frame, 'data'
+
 
 class ParsedFile(base.MusicParsedFile):
     def __init__(self, path):
@@ -129,11 +134,19 @@ class ParsedFile(base.MusicParsedFile):
         self.instance.id3v2_tail = metadata.id3v2_tail
         self.instance.id3v1 = metadata.id3v1
 
+    def regions(self):
+        return [
+            Optional(Id3v2Format).build(self.instance.id3v2_head),
+            (self.instance.audio_offset, self.instance.audio_len),
+            Optional(Id3v2Format).build(self.instance.id3v2_tail),
+            Optional(Id3v1Format).build(self.instance.id3v1),
+        ]
+
 
 class FuseFile(base.FuseFile):
     def __init__(self, file_path, flags, metadata, file_metadata_info, file_metadata_len, frozen_metadata_len):
         super().__init__(file_path, flags, metadata, file_metadata_info, file_metadata_len, frozen_metadata_len)
-        self.audio_len = file_path.stat().st_size - frozen_metadata_len
+        self.audio_len = self.file_size - file_metadata_len
         self._id3v2_head_bytes = None
         self._id3v2_tail_bytes = None
         self._id3v1_bytes = None
@@ -163,44 +176,10 @@ class FuseFile(base.FuseFile):
             self._id3v1_bytes = Optional(Id3v1Format).build(self.metadata['id3v1'])
         return self._id3v1_bytes
 
-    def read(self, length, offset):
-        f = self.file
-        buf = b''
-
-        id3v2_head_len = self.id3v2_head_len
-        if offset < id3v2_head_len:
-            b = self.id3v2_head_bytes()
-            end = min(id3v2_head_len, offset + length)
-            buf = b[offset:end]
-            length -= len(buf)
-            if not length:
-                return buf
-            offset = id3v2_head_len
-        offset -= id3v2_head_len
-
-        audio_len = self.audio_len
-        if offset < audio_len:
-            audio_offset = self.audio_offset + offset
-            f.seek(audio_offset, 0)
-            tmp = f.read(length)
-            length -= len(tmp)
-            buf += tmp
-            if not length:
-                return buf
-            offset = audio_len
-        offset -= audio_len
-
-        id3v2_tail_len = self.id3v2_tail_len
-        if offset < id3v2_tail_len:
-            b = self.id3v2_tail_bytes()
-            end = min(id3v2_tail_len, offset + length)
-            tmp = b[offset:end]
-            length -= len(tmp)
-            buf += tmp
-            if not length:
-                return buf
-            offset = id3v2_tail_len
-        offset -= id3v2_tail_len
-
-        b = self.id3v1_bytes()
-        return buf + b[offset:offset+length]
+    def segments(self):
+        return [
+            (self.id3v2_head_len, self.id3v2_head_bytes),
+            (self.audio_len, self.audio_offset),
+            (self.id3v2_tail_len, self.id3v2_tail_bytes),
+            (self.id3v1_len, self.id3v1_bytes),
+        ]
@@ -1,22 +1,24 @@
 #!/usr/bin/env python3
 
-import gc
+import heapq
 import os
 import platform
+import posixpath
+import sqlite3
 import sys
 import time
 from collections import OrderedDict
 from errno import ENOENT
 from pathlib import Path
-from stat import S_IFDIR
-from threading import Lock, Timer
+from stat import S_IFDIR, S_ISDIR
+from threading import Condition, Lock, RLock, Thread
 
-from appdirs import user_cache_dir
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
 from .base import FuseFile, MusicMetadata, ParsedFile
-from .core import ChecksumDB, Freezetag
+from .core import CACHE_DIR, ChecksumDB, Freezetag, frozen_metadata_len
+from .workers import ordered_map
 
 try:
     from fuse import FUSE, FuseOSError, Operations
@@ -30,26 +32,57 @@ except:
     print(fuse_urls[platform.system()], file=sys.stderr)
     sys.exit(1)
 
-FREEZETAG_CACHE_LIMIT = 10
+# Estimated memory used by cached freezetags, in bytes. See estimate_ftag_size.
+FREEZETAG_CACHE_SIZE = 256 * 1024 * 1024
 FREEZETAG_KEEPALIVE_TIME = 10
-CACHE_DIR = Path(user_cache_dir('freezetag', 'x1ppy'))
+
+# Rough memory overhead of each frozen file's parsed containers, in bytes.
+FROZEN_FILE_OVERHEAD = 1536
+
+# Maximum number of freezetag roots kept expanded in lazy mode.
+EXPANDED_ROOT_LIMIT = 100
+
+# Maximum number of directories whose attributes are cached. See _dir_attrs.
+ATTR_CACHE_LIMIT = 64
+
+# Watchdog events for a path are applied once the path has gone this long without
+# any, in seconds.
+EVENT_QUIET_TIME = 2
+
+# The state of a mount is saved in the checksum database so that the next mount
+# of the same directory can start from it. See FreezeFS._load_snapshot. Snapshots
+# of other versions are ignored.
+SNAPSHOT_VERSION = 1
 
 ST_ITEMS = ['st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid']
-if platform.system() != 'Windows':
+if platform.system() != 'Windows' and hasattr(os.stat_result, 'st_birthtime'):
     ST_ITEMS.append('st_birthtime')
 
 
+# Returns the attributes of a mounted file backed by a file with stat result st.
+def file_attrs(st, size_delta):
+    attrs = {key: getattr(st, key) for key in ST_ITEMS}
+    attrs['st_size'] += size_delta
+    return attrs
+
+
 # An LRU cache with mostly standard behavior besides one thing: it asks whether
 # an item can be purged before doing so. This prevents the cache from purging
 # freezetags that are still be in use by open files; that way, they won't be
 # needlessly recreated in memory if another file with the same freezetag is
 # opened. This also means the cache could technically expand past its maxsize
 # if all items cannot be purged.
+#
+# maxsize is the maximum total of sizeof() of the items, which counts items by
+# default.
 class PoliteLRUCache(OrderedDict):
-    def __init__(self, getter, can_purge, maxsize=128, *args, **kwds):
+    def __init__(self, getter, can_purge, maxsize=128, sizeof=lambda value: 1, *args, **kwds):
         self.maxsize = maxsize
         self.getter = getter
         self.can_purge = can_purge
+        self.sizeof = sizeof
+        self.size = 0
+        self.sizes = {}
         super().__init__(*args, **kwds)
 
     def __getitem__(self, key):
@@ -60,55 +93,153 @@ class PoliteLRUCache(OrderedDict):
         return value
 
     def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
         super().__setitem__(key, value)
-        if len(self) > self.maxsize:
-            for i in range(len(self) - 1):
-                oldest = next(iter(self))
-                if self.can_purge(oldest):
-                    del self[oldest]
-                    break
-                self.move_to_end(oldest)
+        self.sizes[key] = self.sizeof(value)
+        self.size += self.sizes[key]
 
+        # Purge the least recently used items until the cache fits, skipping the
+        # new item and any that can't be purged.
+        for oldest in list(self):
+            if self.size <= self.maxsize:
+                break
+            if oldest != key and self.can_purge(oldest):
+                del self[oldest]
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.size -= self.sizes.pop(key)
+
+
+# Estimates the memory used by a freezetag once all of its metadata is loaded.
+# Blobs that are shared between files are only counted once where they're
+# already loaded (see intern_blobs), and for every file otherwise.
+def estimate_ftag_size(freezetag):
+    frozen = freezetag.data.frozen
+    size = len(freezetag.bytes()) + len(frozen.files) * FROZEN_FILE_OVERHEAD
+    seen = set()
+    for state in frozen.files:
+        size += frozen_metadata_len(state)
+        if freezetag.data.version >= 3:
+            # Don't load any chunks.
+            continue
+        metadata = MusicMetadata.from_state(state)
+        for container, key in metadata.blobs() if metadata else []:
+            blob = container[key]
+            if id(blob) in seen:
+                size -= len(blob)
+            else:
+                seen.add(id(blob))
+    return size
+
+
+# There's one of each of these per mounted file, so they use __slots__ and keep
+# paths as strings rather than Path objects, which are several times larger.
 
 class FrozenItemFreezetagEntry:
-    def __init__(self, freezetag_path, path, metadata_len):
+    __slots__ = ['freezetag_path', 'path', 'checksum', 'metadata_len']
+
+    # path is the file's mounted path as a POSIX string. freezetag_path is shared
+    # by all of the freezetag's entries.
+    def __init__(self, freezetag_path, path, checksum, metadata_len):
         self.freezetag_path = freezetag_path
         self.path = path
+        self.checksum = checksum
         self.metadata_len = metadata_len
 
 
 class FrozenItemFileEntry:
-    def __init__(self, path, metadata_info, metadata_len):
+    __slots__ = ['path', 'metadata_info', 'metadata_len', 'mtime', 'size']
+
+    # path is the file's path as a string.
+    def __init__(self, path, metadata_info, metadata_len, mtime, size):
         self.path = path
-        self.metadata_info = metadata_info
+        self.metadata_info = tuple((sys.intern(type), size) for type, size in metadata_info)
         self.metadata_len = metadata_len
+        self.mtime = mtime
+        self.size = size
 
 
 class FrozenItem:
+    __slots__ = ['checksum', 'freezetags', 'files']
+
+    # freezetags and files are tuples rather than lists since they almost always
+    # hold a single entry.
     def __init__(self, checksum):
         self.checksum = checksum
-        self.freezetags = []
-        self.files = []
+        self.freezetags = ()
+        self.files = ()
 
 
 class FreezeFS(Operations, FileSystemEventHandler):
-    def __init__(self, verbose=False):
-        self.path_map = {Path('/').root: {}}
+    def __init__(self, verbose=False, lazy=False):
+        # Maps each mounted directory's path (as a POSIX string, like the paths FUSE
+        # passes in) to a dict of its children, which are either directory dicts
+        # or FrozenItems.
+        self.dir_map = {'/': {}}
+
+        # Maps each mounted file's path (as a POSIX string) to its
+        # FrozenItemFreezetagEntry.
+        self.entry_map = {}
+
+        # Maps each checksum to its FrozenItem, and each file's path (as a string)
+        # to the FrozenItem of its checksum.
         self.checksum_map = {}
         self.abs_path_map = {}
         self.freezetag_map = {}
         self.inactive_freezetags = []
         self.freezetag_ref_lock = Lock()
+        self.freezetag_ref_cond = Condition(self.freezetag_ref_lock)
         self.fh_map = {}
-        self.checksum_db = ChecksumDB(CACHE_DIR / 'freezefs.db')
+
+        # In lazy mode, freezetags are only read when something under their root is
+        # accessed. Until then, their root is an empty directory mapped to the
+        # freezetag's path in collapsed_roots. Expanded roots are kept in LRU order
+        # in expanded_roots and collapsed again past EXPANDED_ROOT_LIMIT.
+        self.lazy = lazy
+        self.collapsed_roots = {}
+        self.expanded_roots = OrderedDict()
+
+        # Maps mounted directories' paths (as POSIX strings) to a dict of their
+        # children's attributes, in LRU order. See _dir_attrs.
+        self.attr_cache = OrderedDict()
+        self.attr_generation = 0
+
+        # Guards dir_map, entry_map, checksum_map, abs_path_map, freezetag_map,
+        # inactive_freezetags, collapsed_roots, expanded_roots, attr_cache, and
+        # fh_map, which are used by both the FUSE and watchdog threads. If both
+        # locks are needed, this one must be acquired before
+        # self.freezetag_ref_lock. No I/O should happen while it's held.
+        self.map_lock = RLock()
+
+        self.checksum_db = ChecksumDB()
+        if self.checksum_db.existed:
+            print(f'using existing database {self.checksum_db.path}')
+        else:
+            print(f'creating database at {self.checksum_db.path}')
         self.verbose = verbose
 
         # self.freezetag_ref_lock must be acquired before accessing.
-        self.freezetag_cache = PoliteLRUCache(Freezetag.from_path, self._can_purge_ftag, FREEZETAG_CACHE_LIMIT)
+        self.freezetag_cache = PoliteLRUCache(Freezetag.from_path, self._can_purge_ftag, FREEZETAG_CACHE_SIZE,
+                                              estimate_ftag_size)
 
+        # Maps each freezetag path to [expiry time, open file count].
         # self.freezetag_ref_lock must be acquired before accessing.
         self.freezetag_refs = {}
 
+        # Heap of (expiry time, path) for freezetags scheduled to be purged. Entries
+        # whose path has since been rescheduled are skipped.
+        # self.freezetag_ref_lock must be acquired before accessing.
+        self.freezetag_expiry = []
+        Thread(target=self._reap_ftags, daemon=True).start()
+
+        # Maps each path with pending watchdog events to the time of its last event.
+        # See _process_events.
+        # self.event_cond must be acquired before accessing.
+        self.pending_events = {}
+        self.event_cond = Condition()
+
         now = time.time()
 
         try:
@@ -130,21 +261,222 @@ class FreezeFS(Operations, FileSystemEventHandler):
             'st_uid': uid,
         }
 
-    def mount(self, directory, mount_point):
+    def mount(self, directory, mount_point, threaded=False, max_read=None, jobs=1, background_scan=False):
         CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
+        # Paths are saved in the snapshot, so they must not depend on the working directory.
+        directory = str(Path(directory).resolve())
+
+        Thread(target=self._process_events, args=(jobs,), daemon=True).start()
         observer = Observer()
         observer.schedule(self, directory, recursive=True)
         observer.start()
 
-        print(f'scanning {directory} for files and freezetags...')
+        if self._load_snapshot(directory):
+            # Mount right away, and pick up anything that changed since the
+            # snapshot was saved in the background.
+            print(f'reconciling {directory} in the background...')
+            Thread(target=self._scan, args=(directory, jobs), daemon=True).start()
+        elif background_scan:
+            # Mount right away, and add files as they're scanned.
+            print(f'scanning {directory} for files and freezetags in the background...')
+            Thread(target=self._scan, args=(directory, jobs), daemon=True).start()
+        else:
+            print(f'scanning {directory} for files and freezetags...')
+            self._scan(directory, jobs)
 
-        for path in walk_dir(directory):
-            (self._add_ftag if path.suffix.lower() == '.ftag' else self._add_file)(path)
-        self.checksum_db.flush()
+        # Reads larger than FuseFile.READAHEAD_SIZE bypass the readahead buffer and
+        # are passed straight through to the backing file.
+        options = {}
+        if max_read:
+            options['max_read'] = max_read
 
         print(f'mounting {mount_point}')
-        FUSE(self, mount_point, nothreads=True, foreground=True, fsname='freezefs', volname=Path(mount_point).name)
+        FUSE(self, mount_point, nothreads=not threaded, foreground=True, fsname='freezefs',
+             volname=Path(mount_point).name, **options)
+
+        self._save_snapshot(directory)
+
+    # Brings the maps up to date with the files and freezetags in directory. Only
+    # those that are new or have changed since they were added are read.
+    def _scan(self, directory, jobs=1):
+        seen = set()
+
+        def walk():
+            for path in walk_dir(directory):
+                seen.add(str(path))
+                yield path
+
+        # Files and freezetags are read by the worker pool, but only this thread
+        # adds them to the maps, in walk order.
+        for path, is_ftag, changed, loaded in ordered_map(self._scan_path, walk(), jobs):
+            if changed:
+                self._insert_scanned(path, is_ftag, loaded)
+
+        # Anything left over was removed while unmounted. Paths are checked again
+        # in case they were created after the walk passed them.
+        with self.map_lock:
+            stale = [Path(p) for p in list(self.freezetag_map) + list(self.abs_path_map) if str(p) not in seen]
+        for path in stale:
+            if not path.exists():
+                (self._remove_ftag if path.suffix.lower() == '.ftag' else self._remove_file)(path)
+
+        self.checksum_db.compact(directory)
+        self._save_snapshot(directory)
+        print(f'finished scanning {directory}')
+
+    # Reads the file or freezetag at path if it's new or has changed since it was
+    # added. Returns (path, is_ftag, changed, loaded), where loaded is the result
+    # of _load_ftag() or _load_file().
+    def _scan_path(self, path):
+        is_ftag = path.suffix.lower() == '.ftag'
+        try:
+            st = path.stat()
+        except OSError:
+            return path, is_ftag, False, None
+
+        with self.map_lock:
+            if is_ftag:
+                freezetag_map = self.freezetag_map.get(path)
+                unchanged = freezetag_map and freezetag_map[2] == (st.st_mtime, st.st_size)
+            else:
+                key = str(path)
+                item = self.abs_path_map.get(key)
+                entry = item and next((e for e in item.files if e.path == key), None)
+                unchanged = entry and (entry.mtime, entry.size) == (st.st_mtime, st.st_size)
+
+        if unchanged:
+            return path, is_ftag, False, None
+
+        if is_ftag:
+            if freezetag_map:
+                # Don't reuse the old version if it's still cached.
+                self._purge_ftag(path, force=True)
+            return path, is_ftag, True, self._load_ftag(path)
+        return path, is_ftag, True, self._load_file(path)
+
+    # Replaces the file or freezetag at path with loaded, the result of
+    # _load_ftag() or _load_file(), or removes it if it couldn't be read.
+    def _insert_scanned(self, path, is_ftag, loaded):
+        if is_ftag:
+            with self.map_lock:
+                mapped = path in self.freezetag_map
+            if mapped:
+                self._remove_ftag(path)
+            loaded and self._insert_loaded_ftag(path, *loaded)
+        elif loaded:
+            self._insert_loaded_file(*loaded)
+        else:
+            self._remove_file(path)
+
+    def _queue_event(self, path):
+        with self.event_cond:
+            self.pending_events[path] = time.monotonic()
+            self.event_cond.notify()
+
+    # Runs on a single thread for the lifetime of the mount. Events are coalesced
+    # per path, so a file that's written in many chunks is only read once it's
+    # been quiet for EVENT_QUIET_TIME. All of the paths ready at that point are
+    # applied as a batch.
+    def _process_events(self, jobs):
+        with self.event_cond:
+            while True:
+                if not self.pending_events:
+                    self.event_cond.wait()
+                    continue
+
+                now = time.monotonic()
+                ready = [path for path, t in self.pending_events.items() if now - t >= EVENT_QUIET_TIME]
+                if not ready:
+                    self.event_cond.wait(min(self.pending_events.values()) + EVENT_QUIET_TIME - now)
+                    continue
+
+                for path in ready:
+                    del self.pending_events[path]
+
+                # New events keep being queued while the batch is applied.
+                self.event_cond.release()
+                try:
+                    self._apply_events(ready, jobs)
+                finally:
+                    self.event_cond.acquire()
+
+    # Brings the maps up to date with paths that had watchdog events. Like in
+    # _scan(), the paths are read by the worker pool, and only this thread adds
+    # them to the maps.
+    def _apply_events(self, paths, jobs=1):
+        for path, is_ftag, changed, loaded in ordered_map(self._scan_event_path, paths, jobs):
+            if changed is None:
+                self._log_verbose(f'deleting {"freezetag" if is_ftag else "file"} {path}')
+                (self._remove_ftag if is_ftag else self._remove_file)(path)
+            elif changed:
+                self._insert_scanned(path, is_ftag, loaded)
+
+    # Like _scan_path(), but changed is None if path no longer exists. Paths
+    # modified within EVENT_QUIET_TIME are queued again rather than read, since
+    # they're likely still being written.
+    def _scan_event_path(self, path):
+        is_ftag = path.suffix.lower() == '.ftag'
+        try:
+            st = path.stat()
+        except OSError:
+            return path, is_ftag, None, None
+
+        if S_ISDIR(st.st_mode):
+            return path, is_ftag, False, None
+        if 0 <= time.time() - st.st_mtime < EVENT_QUIET_TIME:
+            self._queue_event(path)
+            return path, is_ftag, False, None
+        return self._scan_path(path)
+
+    def _load_snapshot(self, directory):
+        try:
+            snapshot = self.checksum_db.load_snapshot(directory, SNAPSHOT_VERSION)
+        except sqlite3.Error as e:
+            print(f'cannot load mount snapshot: {e}')
+            return False
+        if not snapshot:
+            return False
+        freezetags, entry_rows, files = snapshot
+
+        print(f'using mount snapshot of {directory}')
+
+        ftag_entries = {}
+        for ftag_path, checksum, fuse_path, metadata_len in entry_rows:
+            ftag_entries.setdefault(ftag_path, []).append((checksum, fuse_path, metadata_len))
+
+        with self.map_lock:
+            for ftag_path, root, mtime, size, expanded in freezetags:
+                path = Path(ftag_path)
+                if self.lazy:
+                    entries = None
+                elif not expanded:
+                    # Saved while collapsed, so it's read by the scan instead.
+                    continue
+                else:
+                    entries = [FrozenItemFreezetagEntry(path, fuse_path, checksum, metadata_len)
+                               for checksum, fuse_path, metadata_len in ftag_entries.get(ftag_path, [])]
+                self._insert_ftag(path, Path(root), entries, (mtime, size))
+
+            for path, checksum, metadata_info, metadata_len, mtime, size in files:
+                self._add_path_entry(checksum, FrozenItemFileEntry(path, metadata_info, metadata_len, mtime, size))
+        return True
+
+    def _save_snapshot(self, directory):
+        with self.map_lock:
+            # Collapsed freezetags are saved without their entries.
+            freezetags = [(str(path), str(root), stat[0], stat[1], entries is not None)
+                          for path, (root, entries, stat) in self.freezetag_map.items()]
+            entries = [(str(path), entry.checksum, entry.path, entry.metadata_len)
+                       for path, (root, ftag_entries, stat) in self.freezetag_map.items()
+                       for entry in ftag_entries or ()]
+            files = [(entry.path, item.checksum, entry.metadata_info, entry.metadata_len, entry.mtime, entry.size)
+                     for item in self.checksum_map.values() for entry in item.files]
+
+        try:
+            self.checksum_db.save_snapshot(directory, SNAPSHOT_VERSION, freezetags, entries, files)
+        except sqlite3.Error as e:
+            print(f'cannot save mount snapshot: {e}')
 
     # Helpers
     # =======
@@ -153,93 +485,259 @@ class FreezeFS(Operations, FileSystemEventHandler):
         if self.verbose:
             print(msg)
 
-    def _add_freezetag_entry(self, checksum, entry):
-        if checksum not in self.checksum_map:
-            item = FrozenItem(checksum)
-            self.checksum_map[checksum] = item
+    # self.map_lock must be acquired before calling.
+    def _add_freezetag_entry(self, entry):
+        item = self.checksum_map.get(entry.checksum)
+        if not item:
+            item = FrozenItem(entry.checksum)
+            self.checksum_map[entry.checksum] = item
         else:
-            item = self.checksum_map[checksum]
-
-        item.freezetags.append(entry)
-
-        assert (not self._get_item(entry.path))
-
-        map = self.path_map
-        parts = Path(entry.path).parts
-        for part in parts[0:-1]:
-            if part not in map:
-                map[part] = {}
-            map = map[part]
-        map[parts[-1]] = item
+            # Keep a single copy of each checksum.
+            entry.checksum = item.checksum
+
+        item.freezetags += (entry,)
+
+        key = entry.path
+        assert (not self._path_exists(key))
+
+        parent, name = posixpath.split(key)
+        self._make_dir(parent)[sys.intern(name)] = item
+        self.entry_map[key] = entry
+        self._invalidate_attrs(parent)
+
+    # Returns the children of the directory at key (a POSIX string), creating it
+    # and its parents if needed.
+    # self.map_lock must be acquired before calling.
+    def _make_dir(self, key):
+        dir = self.dir_map.get(key)
+        if dir is None:
+            dir = self.dir_map[key] = {}
+            parent, name = posixpath.split(key)
+            self._make_dir(parent)[sys.intern(name)] = dir
+            self._invalidate_attrs(parent)
+        return dir
+
+    # Drops the cached attributes of the directory at key, and keeps any being
+    # computed by _dir_attrs() from being cached.
+    # self.map_lock must be acquired before calling.
+    def _invalidate_attrs(self, key):
+        self.attr_generation += 1
+        self.attr_cache.pop(key, None)
+
+    # Drops the cached attributes of the directories containing item.
+    # self.map_lock must be acquired before calling.
+    def _invalidate_item_attrs(self, item):
+        for entry in item.freezetags:
+            self._invalidate_attrs(posixpath.dirname(entry.path))
+
+    # Returns a dict of the attributes of each child of the mounted directory at
+    # key, or None if it doesn't exist. Every file in the directory is stat'ed at
+    # once, and the result is cached until something in the directory changes.
+    # Changes that don't go through the maps aren't seen until then, so the cached
+    # st_atime and st_ctime (and any chmod or chown of a backing file) are those
+    # from when the directory was listed.
+    def _dir_attrs(self, key):
+        with self.map_lock:
+            attrs = self.attr_cache.get(key)
+            if attrs is not None:
+                self.attr_cache.move_to_end(key)
+                return attrs
+
+            dir = self.dir_map.get(key)
+            if dir is None:
+                return None
 
+            generation = self.attr_generation
+            children = []
+            for name, item in dir.items():
+                if not isinstance(item, FrozenItem):
+                    children.append((name, None, 0))
+                elif len(item.freezetags) and len(item.files):
+                    frozen_entry = self.entry_map[posixpath.join(key, name)]
+                    file_entry = item.files[0]
+                    children.append((name, file_entry.path, frozen_entry.metadata_len - file_entry.metadata_len))
+
+        attrs = {}
+        for name, file_path, size_delta in children:
+            if file_path is None:
+                attrs[name] = self.dir_stat
+                continue
+            try:
+                attrs[name] = file_attrs(os.stat(file_path), size_delta)
+            except OSError:
+                # Removed, which will be picked up by its watchdog event.
+                pass
+
+        with self.map_lock:
+            if self.attr_generation == generation:
+                self.attr_cache[key] = attrs
+                while len(self.attr_cache) > ATTR_CACHE_LIMIT:
+                    self.attr_cache.popitem(last=False)
+        return attrs
+
+    # self.map_lock must be acquired before calling.
     def _add_path_entry(self, checksum, entry):
+        # The file may have been added already, e.g. by both the scan and a watchdog event.
+        self._remove_file(entry.path)
+
         if checksum not in self.checksum_map:
             item = FrozenItem(checksum)
             self.checksum_map[checksum] = item
         else:
             item = self.checksum_map[checksum]
 
-        item.files.append(entry)
+        item.files += (entry,)
         self.abs_path_map[entry.path] = item
+        self._invalidate_item_attrs(item)
 
-    def _get_item(self, path):
-        item = self.path_map
-        for part in Path(path).parts:
-            if part not in item:
-                return None
-            item = item[part]
-        return item
+    # self.map_lock must be acquired before calling.
+    def _path_exists(self, key):
+        # Empty directories are only left behind for the root and collapsed roots.
+        return key in self.entry_map or key in self.collapsed_roots or bool(self.dir_map.get(key))
 
     def _add_ftag(self, path):
-        self.freezetag_ref_lock.acquire()
+        loaded = self._load_ftag(path)
+        if loaded:
+            self._insert_loaded_ftag(path, *loaded)
+
+    # Reads the freezetag at path, returning (root, entries, stat) for
+    # _insert_loaded_ftag(), or None if it can't be read.
+    def _load_ftag(self, path):
         try:
-            freezetag = self.freezetag_cache[path]
-            self._schedule_purge_ftag(path)
+            st = path.stat()
+        except:
+            print(f'cannot stat freezetag: {path}')
+            return
+
+        try:
+            if self.lazy:
+                # Only the root is needed until the freezetag is expanded.
+                root = Path('/') / Freezetag.header_from_path(path).frozen.root
+                entries = None
+            else:
+                root, entries = self._read_ftag(path)
         except KeyboardInterrupt:
             raise
         except:
             print(f'cannot parse freezetag: {path}')
             return
-        finally:
-            self.freezetag_ref_lock.release()
 
+        return root, entries, (st.st_mtime, st.st_size)
+
+    def _insert_loaded_ftag(self, path, root, entries, stat):
         self._log_verbose(f'adding freezetag: {path}')
 
+        with self.map_lock:
+            # The freezetag may have been added already, e.g. by both the scan and a watchdog event.
+            self._remove_ftag_entries(path)
+            self._insert_ftag(path, root, entries, stat)
+
+    # Returns the root of the freezetag at path and a list of its entries.
+    def _read_ftag(self, path):
+        self.freezetag_ref_lock.acquire()
+        try:
+            freezetag = self.freezetag_cache[path]
+            self._schedule_purge_ftag(path)
+        finally:
+            self.freezetag_ref_lock.release()
+
         root = Path('/') / freezetag.data.frozen.root
-        item = self._get_item(root)
-        if item:
+        entries = []
+        for state in freezetag.data.frozen.files:
+            fuse_path = (root / state.path).as_posix()
+            metadata_len = frozen_metadata_len(state)
+            entries.append(FrozenItemFreezetagEntry(path, fuse_path, state.checksum, metadata_len))
+        return root, entries
+
+    # self.map_lock must be acquired before calling.
+    def _insert_ftag(self, path, root, entries, stat):
+        if self._path_exists(root.as_posix()):
             print(f'cannot mount {path} to {root}: path already mounted by another freezetag')
             self.inactive_freezetags.append([root, path])
             return
 
-        self.freezetag_map[path] = freezetag_map = (root, [])
+        # entries is a list of FrozenItemFreezetagEntry, or None if the
+        # freezetag is collapsed. stat is the freezetag's (mtime, size) when it was read.
+        self.freezetag_map[path] = (root, entries, stat)
 
-        for state in freezetag.data.frozen.files:
-            fuse_path = Path('/') / freezetag.data.frozen.root / state.path
-            metadata = MusicMetadata.from_state(state)
-            metadata_len = sum(m[1] for m in metadata) if metadata else 0
-            entry = FrozenItemFreezetagEntry(path, fuse_path, metadata_len)
-            self._add_freezetag_entry(state.checksum, entry)
-            freezetag_map[1].append(state.checksum)
+        if entries is None:
+            self._make_dir(root.as_posix())
+            self.collapsed_roots[root.as_posix()] = path
+            return
+
+        for entry in entries:
+            self._add_freezetag_entry(entry)
+
+    # Expands the collapsed root containing path, if any, and marks it as recently used.
+    def _expand(self, path):
+        key = '/' + path.split('/')[1]
+        with self.map_lock:
+            ftag_path = self.collapsed_roots.get(key)
+            if not ftag_path:
+                if key in self.expanded_roots:
+                    self.expanded_roots.move_to_end(key)
+                return
+
+        self._log_verbose(f'expanding freezetag: {ftag_path}')
+
+        try:
+            root, entries = self._read_ftag(ftag_path)
+        except KeyboardInterrupt:
+            raise
+        except:
+            print(f'cannot parse freezetag: {ftag_path}')
+            return
+
+        with self.map_lock:
+            # Another thread may have expanded it, or the freezetag may have changed.
+            if self.collapsed_roots.get(key) != ftag_path or root.as_posix() != key:
+                return
+
+            del self.collapsed_roots[key]
+            self.freezetag_map[ftag_path] = (root, entries, self.freezetag_map[ftag_path][2])
+            for entry in entries:
+                self._add_freezetag_entry(entry)
+
+            self.expanded_roots[key] = ftag_path
+            while len(self.expanded_roots) > EXPANDED_ROOT_LIMIT:
+                self._collapse(next(iter(self.expanded_roots)))
+
+    # Removes the entries of an expanded root, leaving just the root directory.
+    # Open files are unaffected since they don't use the maps.
+    # self.map_lock must be acquired before calling.
+    def _collapse(self, key):
+        ftag_path = self.expanded_roots.pop(key)
+        root, entries, stat = self.freezetag_map[ftag_path]
+        self._remove_entries(entries)
+        self.freezetag_map[ftag_path] = (root, None, stat)
+        self._make_dir(root.as_posix())
+        self.collapsed_roots[key] = ftag_path
 
     def _add_file(self, src):
+        loaded = self._load_file(src)
+        if loaded:
+            self._insert_loaded_file(*loaded)
+
+    # Hashes the file at src (or gets its checksum from the cache), returning
+    # (checksum, FrozenItemFileEntry) for _insert_loaded_file(), or None if it
+    # can't be read.
+    def _load_file(self, src):
         try:
             st = src.stat()
         except:
             print(f'cannot stat file: {src}')
             return
 
-        cached = self.checksum_db.get(st.st_dev, st.st_ino, st.st_mtime)
+        cached = self.checksum_db.get(src, st)
         if cached:
             self._log_verbose(f'adding cached file: {src}')
-            checksum, metadata_info, metadata_len, mtime = cached
-            entry = FrozenItemFileEntry(src, metadata_info, metadata_len)
-            self._add_path_entry(checksum, entry)
-            return
+            checksum, metadata_info, metadata_len, metadata_checksum = cached
+            return checksum, FrozenItemFileEntry(str(src), metadata_info, metadata_len, st.st_mtime, st.st_size)
 
         file = ParsedFile.from_path(src)
         try:
-            file.parse()
+            metadata = file.strip()
+            checksum = file.checksum()
         except KeyboardInterrupt:
             raise
         except:
@@ -248,32 +746,103 @@ class FreezeFS(Operations, FileSystemEventHandler):
 
         self._log_verbose(f'adding new file: {src}')
 
-        metadata = file.strip()
         metadata_info = list(metadata) if metadata else []
         metadata_len = sum(m[1] for m in metadata_info) if metadata else 0
-        checksum = file.checksum()
-        entry = FrozenItemFileEntry(src, metadata_info, metadata_len)
-        self.checksum_db.add(st.st_dev, st.st_ino, st.st_mtime, checksum, metadata_info, metadata_len)
-        self._add_path_entry(checksum, entry)
+        entry = FrozenItemFileEntry(str(src), metadata_info, metadata_len, st.st_mtime, st.st_size)
+        self.checksum_db.add(src, st, checksum, metadata_info, metadata_len, metadata.checksum() if metadata else None)
+        return checksum, entry
+
+    def _insert_loaded_file(self, checksum, entry):
+        with self.map_lock:
+            self._add_path_entry(checksum, entry)
 
+    def _remove_file(self, path):
+        key = str(path)
+        with self.map_lock:
+            item = self.abs_path_map.get(key)
+            if not item:
+                return
+
+            for entry in item.files:
+                if entry.path == key:
+                    item.files = tuple(e for e in item.files if e is not entry)
+                    self._delete_if_dangling(item, fuse_path=None, file_path=key)
+                    break
+
+    def _remove_ftag(self, path):
+        self._purge_ftag(path, force=True)
+
+        with self.map_lock:
+            root = self._remove_ftag_entries(path)
+
+            # Mount a freezetag that was blocked by this one, if any.
+            inactive_path = None
+            for tag in self.inactive_freezetags:
+                if root and tag[0] == root:
+                    self.inactive_freezetags.remove(tag)
+                    inactive_path = tag[1]
+                    break
+
+        if inactive_path:
+            self._add_ftag(inactive_path)
+
+    # Removes the entries of the freezetag at path and returns its root, or None
+    # if it wasn't mounted.
+    # self.map_lock must be acquired before calling.
+    def _remove_ftag_entries(self, path):
+        freezetag_map = self.freezetag_map.pop(path, None)
+        if not freezetag_map:
+            for tag in self.inactive_freezetags:
+                if tag[1] == path:
+                    self.inactive_freezetags.remove(tag)
+                    break
+            return None
+
+        root, entries, stat = freezetag_map
+        key = root.as_posix()
+        self.expanded_roots.pop(key, None)
+        if entries is None:
+            del self.collapsed_roots[key]
+            if not self.dir_map[key]:
+                del self.dir_map[key]
+                del self.dir_map[root.parent.as_posix()][root.name]
+                self._invalidate_attrs(key)
+                self._invalidate_attrs(root.parent.as_posix())
+        else:
+            self._remove_entries(entries)
+        return root
+
+    # self.map_lock must be acquired before calling.
+    def _remove_entries(self, entries):
+        for entry in entries:
+            item = self.checksum_map[entry.checksum]
+            item.freezetags = tuple(e for e in item.freezetags if e is not entry)
+            self._delete_if_dangling(item, fuse_path=entry.path, file_path=None)
+
+    # self.map_lock must be acquired before calling.
     def _delete_if_dangling(self, item, fuse_path, file_path):
         if not len(item.freezetags) and not len(item.files):
             del self.checksum_map[item.checksum]
 
         if fuse_path and not any(entry.path == fuse_path for entry in item.freezetags):
-            map = self.path_map
-            parents = []
-            for part in Path(fuse_path).parts:
-                parents.append((part, map))
-                map = map[part]
-            while len(parents):
-                part, parent = parents.pop()
-                del parent[part]
-                if len(parent):
-                    break
-
-        if file_path and not len(item.files):
-            del self.abs_path_map[file_path]
+            del self.entry_map[fuse_path]
+            dir, name = posixpath.split(fuse_path)
+            del self.dir_map[dir][name]
+            self._invalidate_attrs(dir)
+
+            # Remove any directories left empty, except for the root.
+            while dir != '/' and not self.dir_map[dir]:
+                del self.dir_map[dir]
+                parent, name = posixpath.split(dir)
+                del self.dir_map[parent][name]
+                self._invalidate_attrs(parent)
+                dir = parent
+
+        if file_path:
+            # The mounted files may now be backed by another file, or none at all.
+            self._invalidate_item_attrs(item)
+            if not any(entry.path == file_path for entry in item.files):
+                del self.abs_path_map[file_path]
 
     def _can_purge_ftag(self, path):
         assert (self.freezetag_ref_lock.locked())
@@ -285,93 +854,120 @@ class FreezeFS(Operations, FileSystemEventHandler):
     def _purge_ftag(self, path, force):
         self.freezetag_ref_lock.acquire()
         try:
-            no_refs = path in self.freezetag_refs and self.freezetag_refs[path][1] <= 0
-            if (force or no_refs) and path in self.freezetag_cache:
-                del self.freezetag_cache[path]
-                gc.collect()
-            if no_refs and path in self.freezetag_refs:
-                del self.freezetag_refs[path]
+            self._purge_ftag_locked(path, force)
         finally:
             self.freezetag_ref_lock.release()
 
-    def _schedule_purge_ftag(self, path):
+    def _purge_ftag_locked(self, path, force):
         assert (self.freezetag_ref_lock.locked())
 
-        t = Timer(FREEZETAG_KEEPALIVE_TIME, lambda: self._purge_ftag(path, force=False))
-        t.start()
+        no_refs = path in self.freezetag_refs and self.freezetag_refs[path][1] <= 0
+        if (force or no_refs) and path in self.freezetag_cache:
+            del self.freezetag_cache[path]
+        if no_refs and path in self.freezetag_refs:
+            del self.freezetag_refs[path]
+
+    def _schedule_purge_ftag(self, path):
+        assert (self.freezetag_ref_lock.locked())
 
+        expiry = time.monotonic() + FREEZETAG_KEEPALIVE_TIME
         if not path in self.freezetag_refs:
-            self.freezetag_refs[path] = [t, 0]
+            self.freezetag_refs[path] = [expiry, 0]
         else:
-            timer = self.freezetag_refs[path][0]
-            timer and timer.cancel()
-            self.freezetag_refs[path][0] = t
+            self.freezetag_refs[path][0] = expiry
+
+        heapq.heappush(self.freezetag_expiry, (expiry, path))
+        self.freezetag_ref_cond.notify()
+
+    # Runs on a single thread for the lifetime of the mount, purging freezetags
+    # as they expire (see _schedule_purge_ftag).
+    def _reap_ftags(self):
+        with self.freezetag_ref_cond:
+            while True:
+                if not self.freezetag_expiry:
+                    self.freezetag_ref_cond.wait()
+                    continue
+
+                expiry, path = self.freezetag_expiry[0]
+                now = time.monotonic()
+                if expiry > now:
+                    self.freezetag_ref_cond.wait(expiry - now)
+                    continue
+
+                heapq.heappop(self.freezetag_expiry)
+                refs = self.freezetag_refs.get(path)
+                if refs and refs[0] == expiry:
+                    self._purge_ftag_locked(path, force=False)
 
     # Filesystem methods
     # ==================
 
     def getattr(self, path, fh=None):
-        path = Path(path)
-
-        item = self._get_item(path)
-        if item == None:
-            raise FuseOSError(ENOENT)
-
-        if isinstance(item, FrozenItem):
-            if not len(item.freezetags) or not len(item.files):
+        # Roots themselves are in dir_map while collapsed, so looking them up (e.g.,
+        # when the mount point is listed) doesn't expand them.
+        if self.lazy and path.count('/') >= 2:
+            self._expand(path)
+
+        with self.map_lock:
+            if path in self.dir_map:
+                return self.dir_stat
+
+            # Listing the directory may have stat'ed the file already.
+            parent, name = posixpath.split(path)
+            attrs = self.attr_cache.get(parent)
+            if attrs and name in attrs:
+                return attrs[name]
+
+            frozen_entry = self.entry_map.get(path)
+            item = frozen_entry and self.checksum_map[frozen_entry.checksum]
+            if not item or not len(item.files):
                 raise FuseOSError(ENOENT)
 
             file_entry = item.files[0]
-            frozen_entry = None
-            for entry in item.freezetags:
-                if entry.path == path:
-                    frozen_entry = entry
-                    break
+            file_path = file_entry.path
+            size_delta = frozen_entry.metadata_len - file_entry.metadata_len
 
-            if not frozen_entry:
-                raise FuseOSError(ENOENT)
+        return file_attrs(os.stat(file_path), size_delta)
 
-            st = file_entry.path.stat()
-            d = {key: getattr(st, key) for key in ST_ITEMS}
-            d['st_size'] += frozen_entry.metadata_len - file_entry.metadata_len
-            return d
+    def readdir(self, path, fh):
+        if self.lazy and path != '/':
+            self._expand(path)
 
-        return self.dir_stat
+        attrs = self._dir_attrs(path)
+        if attrs is None:
+            raise FuseOSError(ENOENT)
 
-    def readdir(self, path, fh):
-        yield '.'
-        yield '..'
-        for name, item in self._get_item(path).items():
-            if isinstance(item, FrozenItem) and (not len(item.freezetags) or not len(item.files)):
-                continue
-            yield name
+        # FUSE 2 only uses the attributes returned here for each entry's inode and
+        # type, and still sends a getattr() per entry for "ls -l" and the like.
+        # Those are answered from the same cached table (see getattr), so they
+        # don't stat the backing files again.
+        return ['.', '..'] + [(name, st, 0) for name, st in attrs.items()]
 
     # File methods
     # ============
 
     def open(self, path, flags):
-        path = Path(path)
-        item = self._get_item(path)
-        if not item:
-            raise FuseOSError(ENOENT)
-
-        # As long as the raw checksum matches, any file should work, so just use the first one we have.
-        file_entry = item.files[0]
+        if self.lazy:
+            self._expand(path)
 
-        frozen_entry = None
-        for entry in item.freezetags:
-            if entry.path == path:
-                frozen_entry = entry
-                break
+        with self.map_lock:
+            frozen_entry = self.entry_map.get(path)
+            item = frozen_entry and self.checksum_map[frozen_entry.checksum]
+            if not item or not len(item.files):
+                raise FuseOSError(ENOENT)
 
-        if not frozen_entry:
-            raise FuseOSError(ENOENT)
+            # As long as the raw checksum matches, any file should work, so just use the first one we have.
+            file_entry = item.files[0]
 
-        freezetag_path = None
-        metadata = None
-        if frozen_entry.metadata_len:
+            checksum = item.checksum
+            file_path = file_entry.path
+            file_metadata_info = file_entry.metadata_info
+            file_metadata_len = file_entry.metadata_len
+            frozen_metadata_len = frozen_entry.metadata_len
             freezetag_path = frozen_entry.freezetag_path
 
+        metadata = None
+        if frozen_metadata_len:
             self.freezetag_ref_lock.acquire()
             try:
                 if freezetag_path not in self.freezetag_refs:
@@ -381,21 +977,32 @@ class FreezeFS(Operations, FileSystemEventHandler):
             finally:
                 self.freezetag_ref_lock.release()
 
-            for f in freezetag.data.frozen.files:
-                if f.checksum == item.checksum:
-                    metadata = f.metadata
-                    break
+            # Look the file up by path so that identical files frozen with different
+            # metadata get their own, falling back to any file with the same checksum.
+            rel_path = Path(path).relative_to(Path('/') / freezetag.data.frozen.root)
+            f = freezetag.file_by_path(rel_path)
+            if not f or f.checksum != checksum:
+                f = freezetag.file_by_checksum(checksum)
+            metadata = f.metadata if f else None
+        else:
+            freezetag_path = None
 
-        file = FuseFile.from_info(file_entry.path, flags, metadata, file_entry.metadata_info, file_entry.metadata_len,
-                                  frozen_entry.metadata_len)
-        self.fh_map[file.fh] = (file, freezetag_path)
+        file = FuseFile.from_info(Path(file_path), flags, metadata, file_metadata_info, file_metadata_len,
+                                  frozen_metadata_len)
+        with self.map_lock:
+            self.fh_map[file.fh] = (file, freezetag_path)
         return file.fh
 
     def read(self, path, length, offset, fh):
-        return self.fh_map[fh][0].read(length, offset)
+        # FUSE doesn't release a handle while it's being read, so this doesn't
+        # need self.map_lock. Reads from the same handle are serialized.
+        file = self.fh_map[fh][0]
+        with file.lock:
+            return file.read(length, offset)
 
     def release(self, path, fh):
-        f, freezetag_path = self.fh_map[fh]
+        with self.map_lock:
+            f, freezetag_path = self.fh_map.pop(fh)
 
         if freezetag_path:
             self.freezetag_ref_lock.acquire()
@@ -405,12 +1012,15 @@ class FreezeFS(Operations, FileSystemEventHandler):
             finally:
                 self.freezetag_ref_lock.release()
 
-        del self.fh_map[fh]
-        return f.close()
+        with f.lock:
+            return f.close()
 
     # watchdog observers
     # ==================
 
+    # Moves are applied right away, since the maps can be updated without reading
+    # anything. dst is queued too, in case src hadn't been added yet or changed
+    # before it was moved.
     def on_moved(self, event):
         src = Path(event.src_path)
         dst = Path(event.dest_path)
@@ -418,96 +1028,57 @@ class FreezeFS(Operations, FileSystemEventHandler):
             return
 
         self._log_verbose(f'moved: {src} to {dst}')
+        self._queue_event(dst)
 
         if src.suffix.lower() == '.ftag':
             self._purge_ftag(src, force=True)
 
-            freezetag_map = self.freezetag_map.get(src)
-            if not freezetag_map:
-                for tag in self.inactive_freezetags:
-                    if tag[1] == src:
-                        tag[1] = dst
-                        break
-                return
-
-            del self.freezetag_map[src]
-            self.freezetag_map[dst] = freezetag_map
-
-            for checksum in freezetag_map[1]:
-                item = self.checksum_map[checksum]
-                for entry in item.freezetags:
-                    if entry.freezetag_path == src:
+            with self.map_lock:
+                freezetag_map = self.freezetag_map.get(src)
+                if not freezetag_map:
+                    for tag in self.inactive_freezetags:
+                        if tag[1] == src:
+                            tag[1] = dst
+                            break
+                    return
+
+                del self.freezetag_map[src]
+                self.freezetag_map[dst] = freezetag_map
+
+                root, entries, stat = freezetag_map
+                if entries is None:
+                    self.collapsed_roots[root.as_posix()] = dst
+                else:
+                    for entry in entries:
                         entry.freezetag_path = dst
-                        break
+                if root.as_posix() in self.expanded_roots:
+                    self.expanded_roots[root.as_posix()] = dst
             return
 
-        item = self.abs_path_map[src]
-        del self.abs_path_map[src]
-        self.abs_path_map[dst] = item
-
-        for entry in item.files:
-            if entry.path == src:
-                entry.path = dst
-
-    def on_created(self, event):
-        path = Path(event.src_path)
-        if path.is_dir():
-            return
-
-        if path.suffix.lower() == '.ftag':
-            self._add_ftag(path)
-            return
-
-        self._add_file(path)
-
-    def on_deleted(self, event):
-        path = Path(event.src_path)
-
-        if path.suffix.lower() != '.ftag':
-            self._log_verbose(f'deleting file {path}')
-
-            item = self.abs_path_map.get(path)
+        src = str(src)
+        dst = str(dst)
+        with self.map_lock:
+            item = self.abs_path_map.get(src)
             if not item:
                 return
 
-            for entry in item.files:
-                if entry.path == path:
-                    item.files.remove(entry)
-                    self._delete_if_dangling(item, fuse_path=None, file_path=path)
-                    break
-            return
-
-        self._log_verbose(f'deleting freezetag {path}')
+            # The file may have replaced another one.
+            self._remove_file(dst)
+            del self.abs_path_map[src]
+            self.abs_path_map[dst] = item
 
-        self._purge_ftag(path, force=True)
-
-        freezetag_map = self.freezetag_map.get(path)
-        if not freezetag_map:
-            for tag in self.inactive_freezetags:
-                if tag[1] == path:
-                    self.inactive_freezetags.remove(tag)
-                    break
-            return
+            for entry in item.files:
+                if entry.path == src:
+                    entry.path = dst
 
-        for checksum in freezetag_map[1]:
-            item = self.checksum_map[checksum]
-            for entry in item.freezetags:
-                if entry.freezetag_path == path:
-                    item.freezetags.remove(entry)
-                    self._delete_if_dangling(item, fuse_path=entry.path, file_path=None)
-                    break
-        del self.freezetag_map[path]
+    def on_created(self, event):
+        self._queue_event(Path(event.src_path))
 
-        root = freezetag_map[0]
-        for tag in self.inactive_freezetags:
-            if tag[0] == root:
-                self.inactive_freezetags.remove(tag)
-                self._add_ftag(tag[1])
-                break
+    def on_deleted(self, event):
+        self._queue_event(Path(event.src_path))
 
     def on_modified(self, event):
-        self.on_deleted(event)
-        self.on_created(event)
+        self._queue_event(Path(event.src_path))
 
 
 def walk_dir(path):
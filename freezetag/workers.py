@@ -0,0 +1,23 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Like map(), but calls fn from a pool of `jobs` threads. Results are yielded in
+# the same order as their inputs, and only a bounded number of inputs are queued
+# ahead of the result being waited on, so memory stays flat for long iterables.
+#
+# Threads are used rather than processes: hashing and file I/O release the GIL,
+# and parsed construct containers don't need to be pickled across processes.
+def ordered_map(fn, iterable, jobs=1):
+    if jobs <= 1:
+        yield from map(fn, iterable)
+        return
+
+    with ThreadPoolExecutor(jobs) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while len(pending):
+            yield pending.popleft().result()
@@ -28,4 +28,7 @@ setuptools.setup(
         'fusepy',
         'watchdog',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
 )